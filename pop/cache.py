@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+'''
+Read and write the on disk caches used to speed up hub startup
+'''
+# Import python libs
+import os
+import logging
+
+# Import third party libs
+try:
+    import msgpack
+    HAS_MSGPACK = True
+except ImportError:
+    HAS_MSGPACK = False
+
+VERSION = 1
+log = logging.getLogger(__name__)
+
+
+def path(cache_dir, name):
+    '''
+    Return the path to the named cache file, or None if caching is not
+    available
+    '''
+    if not cache_dir:
+        return None
+    if not HAS_MSGPACK:
+        log.debug('msgpack is not available, the %s cache is disabled', name)
+        return None
+    return os.path.join(cache_dir, f'{name}.mp')
+
+
+def load(path_):
+    '''
+    Read in the cache file, a missing, unreadable or outdated cache is
+    just empty
+    '''
+    try:
+        with open(path_, 'rb') as rfh:
+            data = msgpack.loads(rfh.read(), raw=False)
+    except Exception:  # pylint: disable=broad-except
+        return {}
+    if not isinstance(data, dict) or data.get('version') != VERSION:
+        return {}
+    return data.get('data', {})
+
+
+def dump(path_, data):
+    '''
+    Write the cache file, the write is atomic so that concurrently starting
+    processes never read a partial cache
+    '''
+    mp = msgpack.dumps({'version': VERSION, 'data': data}, use_bin_type=True)
+    tmp = f'{path_}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(path_), exist_ok=True)
+        with open(tmp, 'wb') as wfh:
+            wfh.write(mp)
+        os.replace(tmp, path_)
+    except OSError as exc:
+        log.debug('Failed to write cache %s: %s', path_, exc)
+        return False
+    return True
@@ -4,24 +4,95 @@ Contracts to enforce loader objects
 '''
 
 # Import python libs
+import asyncio
 import inspect
-import os
-from collections import namedtuple
+import functools
 
 # Import pop libs
 import pop.exc
+import pop.hub
 import pop.verify
 
-FUNC_DEFAULTS = set(['__call__', '__class__', '__delattr__', '__dict__', '__dir__', '__doc__', '__eq__', '__format__', '__ge__', '__getattr__', '__getattribute__', '__gt__', '__hash__', '__init__', '__init_subclass__', '__le__', '__lt__', '__module__', '__ne__', '__new__', '__reduce__', '__reduce_ex__', '__repr__', '__setattr__', '__sizeof__', '__str__', '__subclasshook__', '__weakref__', '_get_contracts_by_type', '_has_contracts', '_load_contracts', '_sig_errors', 'contract_functions', 'contracts', 'func', 'hub', 'name', 'ref', 'signature'])
+# The hub used to run functions in the processes of a process executor
+_PROC_HUB = None
+# The pop.profile.Profiler every call is passed through while profiling is on
+PROFILER = None
 
-class ContractedContext(namedtuple('ContractedContext', ('func', 'args', 'kwargs', 'signature', 'ret', 'cache'))):
+
+def executor(kind='thread'):
+    '''
+    Decorate a function to run it in the executor of the given kind, thread
+    or process, owned by hub.pop.loop when it is called with a running loop.
+    The call then returns a future to await. Contract modules can set
+    __executor__ to do the same for all of the functions they apply to
+    '''
+    def _mark(func):
+        func.__executor__ = kind
+        return func
+    return _mark
+
+
+def _run_in_process(specs, ref, args, kwargs):
+    '''
+    Run the function at ref on the hub of this executor process, the subs on
+    the path to it are added from the specs the first time
+    '''
+    global _PROC_HUB  # pylint: disable=global-statement
+    if _PROC_HUB is None:
+        _PROC_HUB = pop.hub.Hub()
+    # pylint: disable=protected-access
+    parent = None
+    for spec in specs:
+        subs = (_PROC_HUB if parent is None else parent)._subs
+        if spec['subname'] not in subs:
+            _PROC_HUB.pop.sub.add(sub=parent, **spec)
+        parent = subs[spec['subname']]
+    return _PROC_HUB.pop.ref.last(ref)(*args, **kwargs)
+
+
+class ContractedContext:
     '''
     Contracted function calling context
     '''
-    def __new__(cls, func, args, kwargs, signature, ret=None, cache=None):  # pylint: disable=too-many-arguments
-        if cache is None:
-            cache = {}
-        return super(ContractedContext, cls).__new__(cls, func, list(args), kwargs, signature, ret, cache)
+    __slots__ = ('func', 'args', 'kwargs', 'signature', 'ret', '_cache', '_binder')
+
+    def __init__(self, func, args, kwargs, signature, ret=None, cache=None, binder=None):  # pylint: disable=too-many-arguments
+        self.func = func
+        # The args are a list the contracts can modify, or a tuple when all
+        # of the contracts declared that they do not modify them
+        self.args = args
+        self.kwargs = kwargs
+        self.signature = signature
+        self.ret = ret
+        self._cache = cache
+        self._binder = binder
+
+    @property
+    def cache(self):
+        '''
+        A dict shared by all of the contracts run for this call, created on
+        first use
+        '''
+        if self._cache is None:
+            self._cache = {}
+        return self._cache
+
+    def _replace(self, **kwargs):
+        '''
+        Return a copy of this context with the given fields replaced, the
+        cache is shared with the copy
+        '''
+        fields = {
+            'func': self.func,
+            'args': self.args,
+            'kwargs': self.kwargs,
+            'signature': self.signature,
+            'ret': self.ret,
+            'cache': self.cache,
+            'binder': self._binder,
+        }
+        fields.update(kwargs)
+        return ContractedContext(**fields)
 
     def get_argument(self, name):
         '''
@@ -35,17 +106,78 @@ class ContractedContext(namedtuple('ContractedContext', ('func', 'args', 'kwargs
         Return a dictionary of all arguments that will be passed to the function and their
         values, including default arguments.
         '''
-        if '__bound_signature__' not in self.cache:
-            try:
-                self.cache['__bound_signature__'] = self.signature.bind(*self.args, **self.kwargs)
-            except TypeError as e:
-                for frame in inspect.trace():
-                    if frame.function == 'bind' and frame.filename.endswith(os.sep+'inspect.py'):
-                        raise pop.exc.BindError(e)
-                raise
-            # Apply any default values from the signature
-            self.cache['__bound_signature__'].apply_defaults()
-        return self.cache['__bound_signature__'].arguments
+        cache = self.cache
+        if '__bound_arguments__' not in cache:
+            arguments = None
+            if self._binder is not None:
+                arguments = self._binder.bind(self.args, self.kwargs)
+            if arguments is None:
+                # The arguments do not fit the precomputed plan, let inspect
+                # bind them and report any errors
+                try:
+                    bound = self.signature.bind(*self.args, **self.kwargs)
+                except TypeError as e:
+                    raise pop.exc.BindError(e)
+                # Apply any default values from the signature
+                bound.apply_defaults()
+                arguments = bound.arguments
+            cache['__bound_arguments__'] = arguments
+        return cache['__bound_arguments__']
+
+
+class ArgBinder:
+    '''
+    A precomputed plan to bind call arguments to the parameters of a
+    function signature, without building inspect.BoundArguments on each call.
+    Only signatures made of plain positional or keyword and keyword only
+    parameters are supported, use ArgBinder.from_signature to get a binder
+    if one can be made.
+    '''
+    __slots__ = ('names', 'npos', 'index', 'defaults')
+
+    def __init__(self, names, npos, defaults):
+        self.names = names
+        self.npos = npos
+        self.index = {name: ind for ind, name in enumerate(names)}
+        self.defaults = defaults
+
+    @classmethod
+    def from_signature(cls, signature):
+        '''
+        Return an ArgBinder for the signature, or None if it has parameters
+        the plan cannot handle
+        '''
+        names = []
+        defaults = []
+        npos = 0
+        for param in signature.parameters.values():
+            if param.kind is inspect.Parameter.POSITIONAL_OR_KEYWORD:
+                npos += 1
+            elif param.kind is not inspect.Parameter.KEYWORD_ONLY:
+                return None
+            names.append(param.name)
+            defaults.append(param.default)
+        return cls(tuple(names), npos, tuple(defaults))
+
+    def bind(self, args, kwargs):
+        '''
+        Return a dict of the parameter names to the bound values, including
+        defaults. Return None if the arguments cannot be bound.
+        '''
+        nargs = len(args)
+        if nargs > self.npos:
+            return None
+        values = [*args, *self.defaults[nargs:]]
+        for name, value in kwargs.items():
+            ind = self.index.get(name)
+            if ind is None or ind < nargs:
+                # Unexpected or multiple values for the argument
+                return None
+            values[ind] = value
+        for value in values:
+            if value is inspect.Parameter.empty:
+                return None
+        return dict(zip(self.names, values))
 
 
 def load_contract(contracts, default_contracts, mod, name):
@@ -86,15 +218,32 @@ class Wrapper:  # pylint: disable=too-few-public-methods
         self.func = func
         self.ref = ref
         self.name = name
-        self.__load_self()
-        self.signature = inspect.signature(self.func)
+        self._signature = None
         self._sig_errors = []
 
-    def __load_self(self):
-        if callable(self.func):
-            attrs = set(dir(self.func))
-            for attr in attrs.difference(FUNC_DEFAULTS):
-                setattr(self, attr, getattr(self.func, attr))
+    @property
+    def signature(self):
+        '''
+        The signature of the wrapped function, read on first use
+        '''
+        if self._signature is None:
+            self._signature = inspect.signature(self.func)
+        return self._signature
+
+    def __getattr__(self, item):
+        '''
+        Expose the attributes of the wrapped function
+        '''
+        try:
+            func = self.__dict__['func']
+        except KeyError:
+            raise AttributeError(item)
+        return getattr(func, item)
+
+    def __dir__(self):
+        ret = set(super().__dir__())
+        ret.update(dir(self.func))
+        return sorted(ret)
 
     def __call__(self, *args, **kwargs):
         self.func(*args, **kwargs)
@@ -103,6 +252,68 @@ class Wrapper:  # pylint: disable=too-few-public-methods
         return '<{} func={}.{}>'.format(self.__class__.__name__, self.func.__module__, self.name)
 
 
+def _notify(base, name):
+    '''
+    Return the named method of the base class that recomposes the call of
+    the Contracted that owns the container after it has run
+    '''
+    method = getattr(base, name)
+
+    def _changed(self, *args, **kwargs):
+        ret = method(self, *args, **kwargs)
+        self._owner._compose()  # pylint: disable=protected-access
+        return ret
+    _changed.__name__ = name
+    return _changed
+
+
+class _ContractList(list):
+    '''
+    A list of the contract functions of one type, changing it recomposes the
+    call of the Contracted it belongs to
+    '''
+    __slots__ = ('_owner',)
+
+    def __init__(self, owner, funcs=()):
+        super().__init__(funcs)
+        self._owner = owner
+
+
+for _name in ('__setitem__', '__delitem__', '__iadd__', 'append', 'extend', 'insert',
+              'pop', 'remove', 'clear', 'sort', 'reverse'):
+    setattr(_ContractList, _name, _notify(list, _name))
+
+
+class _ContractFunctions(dict):
+    '''
+    The contract functions of a Contracted by type, changing them recomposes
+    its call
+    '''
+    __slots__ = ('_owner',)
+
+    def __init__(self, owner, funcs):
+        super().__init__((key, _ContractList(owner, val)) for key, val in funcs.items())
+        self._owner = owner
+
+    def __setitem__(self, key, funcs):
+        super().__setitem__(key, _ContractList(self._owner, funcs))
+        self._owner._compose()  # pylint: disable=protected-access
+
+    def update(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        for key, funcs in dict(*args, **kwargs).items():
+            super().__setitem__(key, _ContractList(self._owner, funcs))
+        self._owner._compose()  # pylint: disable=protected-access
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = [] if default is None else default
+        return self[key]
+
+
+for _name in ('__delitem__', 'pop', 'popitem', 'clear'):
+    setattr(_ContractFunctions, _name, _notify(dict, _name))
+
+
 class Contracted(Wrapper):  # pylint: disable=too-few-public-methods
     '''
     This class wraps functions that have a contract associated with them
@@ -112,6 +323,8 @@ class Contracted(Wrapper):  # pylint: disable=too-few-public-methods
         super().__init__(func, ref, name)
         self.hub = hub
         self.contracts = contracts if contracts else []
+        self._binder = None
+        self._executor = None
         self._load_contracts()
 
     def _get_contracts_by_type(self, contract_type='pre'):
@@ -126,28 +339,131 @@ class Contracted(Wrapper):  # pylint: disable=too-few-public-methods
         return matches
 
     def _load_contracts(self):
-        self.contract_functions = {'pre': self._get_contracts_by_type('pre'),
-                                   'call': self._get_contracts_by_type('call')[:1],
-                                   'post': self._get_contracts_by_type('post'),
-                                   }
-        self._has_contracts = sum([len(l) for l in self.contract_functions.values()]) > 0
+        funcs = {'pre': self._get_contracts_by_type('pre'),
+                 'call': self._get_contracts_by_type('call')[:1],
+                 'post': self._get_contracts_by_type('post'),
+                 }
+        self._has_contracts = sum([len(l) for l in funcs.values()]) > 0
+        # Contract modules set __readonly__ = True to declare that they never
+        # modify the call args, when all of them do the args are not copied
+        self._readonly = all(getattr(contract, '__readonly__', False) is True for contract in self.contracts)
+        self.contract_functions = funcs
 
-    def __call__(self, *args, **kwargs):
-        args = (self.hub,) + args
+    @property
+    def contract_functions(self):
+        '''
+        The contract functions run around the function by type, pre, call and
+        post. The call is composed from them once, replacing or changing them
+        composes it again
+        '''
+        return self._contract_functions
 
-        if not self._has_contracts:
-            return self.func(*args, **kwargs)
-        contract_context = ContractedContext(self.func, args, kwargs, self.signature)
+    @contract_functions.setter
+    def contract_functions(self, funcs):
+        self._contract_functions = _ContractFunctions(self, funcs)
+        self._compose()
 
-        for fn in self.contract_functions['pre']:
-            fn(contract_context)
-        if self.contract_functions['call']:
-            ret = self.contract_functions['call'][0](contract_context)
+    def _compose(self):
+        '''
+        Make the callable used to run this function from the current contract
+        functions
+        '''
+        self._call = self._mk_call()
+
+    def _mk_call(self):
+        '''
+        Return the callable used to run this function. When no contracts
+        applied when it was loaded the hub is bound to the function up front,
+        otherwise the call is run through the contracts
+        '''
+        if not self._has_contracts:
+            call = functools.partial(self.func, self.hub)
         else:
-            ret = self.func(*contract_context.args, **contract_context.kwargs)
-        for fn in self.contract_functions['post']:
-            post_ret = fn(contract_context._replace(ret=ret))
-            if post_ret is not None:
-                ret = post_ret
+            self._binder = ArgBinder.from_signature(self.signature)
+            call = self._mk_run_contracts()
+        self._executor = getattr(self.func, '__executor__', None)
+        for contract in self.contracts:
+            if self._executor:
+                break
+            self._executor = getattr(contract, '__executor__', None)
+        if self._executor:
+            self._run_in_place = call
+            return self._run_offloaded
+        return call
 
-        return ret
+    def _run_offloaded(self, *args, **kwargs):
+        '''
+        Run the call in the executor of hub.pop.loop and return the future
+        when there is a running loop, otherwise run it in place
+        '''
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return self._run_in_place(*args, **kwargs)
+        if self._executor == 'process':
+            specs, ref = self._process_spec()
+            return self.hub.pop.loop.offload('process', _run_in_process, specs, ref, args, kwargs)
+        return self.hub.pop.loop.offload(self._executor, self._run_in_place, *args, **kwargs)
+
+    def _process_spec(self):
+        '''
+        Return the arguments to add each of the subs on the way to this
+        function, outermost first, on the hub of a process executor and the
+        reference of the function from the hub. The ref of a function on a
+        nested sub starts at its own sub, so the subs of the hub are walked to
+        find the path to it
+        '''
+        # pylint: disable=protected-access
+        subname, modname = self.ref.rsplit('.', 1)
+        paths = [[sub] for sub in self.hub._subs.values()]
+        while paths:
+            path = paths.pop()
+            sub = path[-1]
+            mod = sub._loaded.get(modname) if sub._subname == subname else None
+            if mod is not None and mod._attrs.get(self.name) is self:
+                ref = '.'.join([node._subname for node in path] + [modname, self.name])
+                return [node._add_spec() for node in path], ref
+            paths.extend(path + [child] for child in sub._subs.values())
+        raise pop.exc.PopLookupError(f'{self.ref}.{self.name} is not on a sub of the hub')
+
+    def _mk_run_contracts(self):
+        '''
+        Return a function that runs the function wrapped by the pre, call and
+        post contracts, the contract functions are looked up now rather than
+        on each call
+        '''
+        funcs = self._contract_functions
+        pre = tuple(funcs.get('pre', ()))
+        call = funcs['call'][0] if funcs.get('call') else None
+        post = tuple(funcs.get('post', ()))
+        hub = self.hub
+        signature = self.signature
+        binder = self._binder
+        readonly = self._readonly
+
+        def _run_contracts(*args, **kwargs):
+            # hub._ falls back to reading self from the frame of the caller
+            func = self.func
+            if readonly:
+                args = (hub,) + args
+            else:
+                args = [hub, *args]
+            contract_context = ContractedContext(func, args, kwargs, signature, binder=binder)
+            for fn in pre:
+                fn(contract_context)
+            if call is not None:
+                ret = call(contract_context)
+            else:
+                ret = func(*contract_context.args, **contract_context.kwargs)
+            for fn in post:
+                contract_context.ret = ret
+                post_ret = fn(contract_context)
+                if post_ret is not None:
+                    ret = post_ret
+            return ret
+        return _run_contracts
+
+    def __call__(self, *args, **kwargs):
+        if PROFILER is None:
+            return self._call(*args, **kwargs)
+        return PROFILER.call(self, args, kwargs)
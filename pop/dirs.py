@@ -5,8 +5,13 @@ Find directories
 # Import python libs
 import os
 import sys
+import time
 import importlib
 
+# Import pop libs
+import pop.cache
+import pop.scanner
+
 
 def dir_list(subname, p_name, pypath=None, static=None):
     '''
@@ -35,28 +40,84 @@ def inline_dirs(dirs, subdir):
     return ret
 
 
-def dynamic_dirs():
+def dynamic_dirs(cache_dir=None):
     '''
     Iterate over the available python package imports and look for configured
     dynamic dirs
+
+    :param cache_dir: If passed the DYNE declarations found under each
+        sys.path entry are stored in an index in this directory. The entry is
+        only scanned again when its mtime, or the mtime of one of the package
+        dirs, egg-links or conf.py files found under it, changes
     '''
-    dirs = []
+    index_path = pop.cache.path(cache_dir, 'dyne')
+    index = pop.cache.load(index_path) if index_path else {}
+    dirty = False
     ret = {}
     for dir_ in sys.path:
         if not os.path.isdir(dir_):
             continue
-        for sub in os.listdir(dir_):
-            full = os.path.join(dir_, sub)
-            if full.endswith('.egg-link'):
-                with open(full) as rfh:
-                    dirs.append(rfh.read().strip())
-            if os.path.isdir(full):
-                dirs.append(full)
-    for dir_ in dirs:
-        conf = os.path.join(dir_, 'conf.py')
+        entry = index.get(dir_)
+        if not entry or not _entry_current(dir_, entry):
+            entry = _scan_entry(dir_)
+            index[dir_] = entry
+            dirty = True
+        for name, paths in entry['dyne'].items():
+            if name not in ret:
+                ret[name] = []
+            ret[name].extend(paths)
+    if index_path and dirty:
+        pop.cache.dump(index_path, index)
+    return ret
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _entry_current(dir_, entry):
+    '''
+    Return True if the cached DYNE index entry for the given sys.path entry
+    is still valid
+    '''
+    if _mtime(dir_) != entry['mtime'] or 'paths' not in entry:
+        return False
+    latest = entry['mtime'] or 0
+    for path, mtime in entry['paths'].items():
+        if _mtime(path) != mtime:
+            return False
+        latest = max(latest, mtime or 0)
+    # A scan taken within a tick of a change could have missed a later change
+    # that did not move the mtime
+    return entry['scanned'] - latest > pop.scanner.MTIME_TICK_NS
+
+
+def _scan_entry(dir_):
+    '''
+    Find all of the DYNE declarations in the packages under a single sys.path
+    entry. The mtimes of every package dir, egg-link and conf.py looked at are
+    recorded, so that a conf.py that is added or changed is picked up
+    '''
+    ret = {'mtime': _mtime(dir_), 'scanned': time.time_ns(), 'paths': {}, 'dyne': {}}
+    dirs = []
+    for sub in os.listdir(dir_):
+        full = os.path.join(dir_, sub)
+        if full.endswith('.egg-link'):
+            ret['paths'][full] = _mtime(full)
+            with open(full) as rfh:
+                dirs.append(rfh.read().strip())
+        if os.path.isdir(full):
+            dirs.append(full)
+    for pdir in dirs:
+        ret['paths'][pdir] = _mtime(pdir)
+        conf = os.path.join(pdir, 'conf.py')
         context = {}
         if not os.path.isfile(conf):
             continue
+        ret['paths'][conf] = _mtime(conf)
         try:
             with open(conf) as f:
                 code = f.read()
@@ -72,8 +133,8 @@ def dynamic_dirs():
             for name, paths in context['DYNE'].items():
                 if not isinstance(paths, list):
                     continue
-                if name not in ret:
-                    ret[name] = []
+                if name not in ret['dyne']:
+                    ret['dyne'][name] = []
                 for path in paths:
-                    ret[name].append(os.path.join(dir_, path.replace('.', os.sep)))
+                    ret['dyne'][name].append(os.path.join(pdir, path.replace('.', os.sep)))
     return ret
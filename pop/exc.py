@@ -54,6 +54,17 @@ class ProcessNotStarted(PopBaseException):
     '''
 
 
+class ProcFrameError(PopBaseException):
+    '''
+    Exception raised when the body of a proc frame cannot be decoded, the
+    frame has been read in full so the stream can still be used
+    '''
+    def __init__(self, rid, flag, msg):
+        super().__init__(msg)
+        self.rid = rid
+        self.flag = flag
+
+
 class BindError(PopBaseException):
     '''
     Exception raised when arguments for a function in a ContractedContext cannot be bound
@@ -36,11 +36,21 @@ class Hub:
     '''
     The redistributed pop central hub. All components of the system are
     rooted to the Hub.
+
+    :param cache_dir: A directory used to persist the module scan data between
+        runs, defaults to the POP_CACHE_DIR environment variable. When not set
+        no cache is used
     '''
-    def __init__(self):
+    def __init__(self, cache_dir=None):
         self._subs = {}
         self._dynamic = {}
         self._dscan = False
+        # Resolved dotted refs, see pop.mods.pop.ref
+        self._ref_cache = {}
+        if cache_dir is None:
+            cache_dir = os.environ.get('POP_CACHE_DIR')
+        self._cache_dir = cache_dir
+        self._scan_cache = pop.scanner.mk_cache(cache_dir)
         self._subs['pop'] = Sub(
                 self,
                 'pop',
@@ -50,6 +60,13 @@ class Hub:
         # Set up the conf OPT structure so it is always available
         self.OPT = {}
 
+    @property
+    def _root(self):
+        '''
+        The root hub, a ModHub returns the hub it was made from
+        '''
+        return self
+
     def __getstate__(self):
         return dict(
             _subs=self._subs,
@@ -69,6 +86,10 @@ class Hub:
         This function allows for hub to pop introspective calls.
         This should only ever be called from within a hub module, otherwise
         it should stack trace, or return heaven knows what...
+
+        Functions on the hub are passed a ModHub that resolves these
+        references directly, the stack is only inspected when a hub that was
+        passed in some other way is used.
         '''
         if hasattr(sys, '_getframe'):  # implementation detail of CPython, speeds up things by 100x.
             desired_frame = sys._getframe(3)
@@ -102,7 +123,7 @@ class Hub:
         '''
         Refresh the dynamic roots data used for loading app merge module roots
         '''
-        self._dynamic = pop.dirs.dynamic_dirs()
+        self._dynamic = pop.dirs.dynamic_dirs(self._cache_dir)
         self._dscan = True
 
     def __getattr__(self, item):
@@ -112,12 +133,48 @@ class Hub:
             else:
                 return self.__getattribute__(item)
         if '.' in item:
+            if item in self._ref_cache:
+                return self._ref_cache[item][-1]
             return self.pop.ref.last(item)
         if item in self._subs:
             return self._subs[item]
         return self.__getattribute__(item)
 
 
+class ModHub(Hub):
+    '''
+    The hub as it is passed to the functions of a loaded module. It shares
+    all of its state with the hub it was made from, but knows the ref of the
+    module so that hub._ and hub.__ are resolved without inspecting the stack.
+    It compares equal to the root hub, use hub._root to get the root hub
+    itself.
+    '''
+    __slots__ = ('_root', '_mod_ref')
+
+    def __init__(self, hub, ref):  # pylint: disable=super-init-not-called
+        if isinstance(hub, ModHub):
+            hub = hub._root
+        self.__dict__ = hub.__dict__
+        self._root = hub
+        self._mod_ref = tuple(ref.split('.'))
+
+    def __eq__(self, other):
+        return getattr(other, '__dict__', None) is self.__dict__
+
+    def __hash__(self):
+        return hash(self._root)
+
+    def _resolve_this(self, levels):
+        '''
+        Resolve the module (1), or one of its parents, that this hub was made
+        for
+        '''
+        traversed = self
+        for chunk in self._mod_ref[:len(self._mod_ref) - levels + 1]:
+            traversed = getattr(traversed, chunk)
+        return traversed
+
+
 class Sub:
     '''
     The pop object contains the loaded module data
@@ -144,7 +201,8 @@ class Sub:
             is_contract=False,
             ):
         self._iter_ind = 0
-        self._hub = hub
+        # Subs added from a function on the hub are passed its ModHub
+        self._hub = hub._root
         self._subs = {}
         self._mem = {}
         self._subname = subname
@@ -168,6 +226,29 @@ class Sub:
         self._is_contract = is_contract
         self._prepare()
 
+    def _add_spec(self):
+        '''
+        Return the arguments to pass to hub.pop.sub.add to add this sub again
+        on another hub
+        '''
+        return {
+            'pypath': self._pypath,
+            'subname': self._subname,
+            'static': self._static,
+            'contracts_pypath': self._contracts_pypath,
+            'contracts_static': self._contracts_static,
+            'default_contracts': self._default_contracts,
+            'virtual': self._virtual,
+            'dyne_name': self._dyne_name,
+            'omit_start': self._omit_start,
+            'omit_end': self._omit_end,
+            'omit_func': self._omit_func,
+            'omit_class': self._omit_class,
+            'omit_vars': self._omit_vars,
+            'mod_basename': self._mod_basename,
+            'stop_on_failures': self._stop_on_failures,
+            'init': self._init}
+
     def _prepare(self):
         self._dirs = pop.dirs.dir_list(
             self._subname,
@@ -199,7 +280,11 @@ class Sub:
             self._contracts = None
         self._name_root = self._load_name_root()
         self._mem = {}
-        self._scan = pop.scanner.scan(self._dirs)
+        self._scan = pop.scanner.scan(
+            self._dirs,
+            getattr(self._hub, '_scan_cache', None))
+        self._scan_index = pop.scanner.index(self._scan)
+        self._vindex = None
         self._loaded = {}
         self._vmap = {}
         self._load_errors = {}
@@ -254,7 +339,10 @@ class Sub:
         if item.startswith('_'):
             return self.__getattribute__(item)
         if '.' in item:
-            return self._hub.pop.ref.last(f'{self._subname}.{item}')
+            ref = f'{self._subname}.{item}'
+            if ref in self._hub._ref_cache:
+                return self._hub._ref_cache[ref][-1]
+            return self._hub.pop.ref.last(ref)
         if item in self._loaded:
             ret = self._loaded[item]
             # If this previously errored on load, try it again,
@@ -269,6 +357,18 @@ class Sub:
             return self._subs[item]
         return self._find_mod(item)
 
+    def __setattr__(self, item, value):
+        if not item.startswith('_') and (item in self._loaded or item in self._subs):
+            # Shadowing a loaded module or nested sub changes what refs
+            # through this sub resolve to
+            self._hub._ref_cache.clear()
+        object.__setattr__(self, item, value)
+
+    def __delattr__(self, item):
+        if not item.startswith('_') and (item in self._loaded or item in self._subs):
+            self._hub._ref_cache.clear()
+        object.__delattr__(self, item)
+
     def __contains__(self, item):
         try:
             return hasattr(self, item)
@@ -327,20 +427,23 @@ class Sub:
         '''
         find the module named item
         '''
-        for iface in self._scan:
-            for bname in self._scan[iface]:
-                if os.path.basename(bname) == item:
-                    self._load_item(iface, bname)
+        for iface, bnames in self._scan_index.get(item, {}).items():
+            for bname in bnames:
+                self._load_item(iface, bname)
             if item in self._loaded:
                 return self._loaded[item]
         if not match_only:
-            for iface in self._scan:
-                for bname in self._scan[iface]:
-                    if self._scan[iface][bname].get('loaded'):
-                        continue
-                    self._load_item(iface, bname)
-                    if item in self._loaded:
-                        return self._loaded[item]
+            # Only load the modules that declare the item as their
+            # __virtualname__, or whose name could not be read statically
+            if self._vindex is None:
+                self._vindex = pop.scanner.vname_index(self._scan)
+            for _, iface, bname in sorted(
+                    self._vindex.get(item, []) + self._vindex.get(None, [])):
+                if self._scan[iface][bname].get('loaded'):
+                    continue
+                self._load_item(iface, bname)
+                if item in self._loaded:
+                    return self._loaded[item]
         # Let's see if the module being lookup is in the load errors dictionary
         if item in self._load_errors:
             # Return the LoadError
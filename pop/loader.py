@@ -13,6 +13,7 @@ import traceback as stdlib_traceback
 
 # Import pop libs
 import pop.exc
+import pop.hub
 import pop.contract
 
 
@@ -212,8 +213,10 @@ def prep_loaded_mod(this_sub, mod, mod_name, contracts):
     aliases and omits objects that should not be exposed.
     '''
     # pylint: disable=protected-access
-    lmod = LoadedMod(mod_name)
+    lmod = LoadedMod(mod_name, this_sub._hub._ref_cache)
     ref = f'{this_sub._subname}.{mod_name}'  # getattr(hub, ref) should resolve to this module
+    # The functions are passed a hub that knows this module, for hub._
+    mod_hub = pop.hub.ModHub(this_sub._hub, ref)
     for attr in getattr(mod, '__load__', dir(mod)):
         name = getattr(mod, '__func_alias__', {}).get(attr, attr)
         func = getattr(mod, attr)
@@ -229,7 +232,7 @@ def prep_loaded_mod(this_sub, mod, mod_name, contracts):
             continue
         if inspect.isfunction(func) or inspect.isbuiltin(func) or \
                 type(func).__name__ == 'cython_function_or_method':
-            obj = pop.contract.Contracted(this_sub._hub, contracts, func, ref, name)
+            obj = pop.contract.Contracted(mod_hub, contracts, func, ref, name)
             if not this_sub._omit_func:
                 if this_sub._pypath and not func.__module__.startswith(mod.__name__):
                     # We're only interested in functions defined in this module, not
@@ -255,18 +258,32 @@ class LoadedMod:
     custom sequencing, for instance it can be iterated over to return all
     functions
     '''
-    def __init__(self, name):
+    def __init__(self, name, ref_cache=None):
         self.__sub_name__ = name
         self._vars = {}
         self._funcs = {}
         self._classes = {}
         self._attrs = {}
+        # The resolved ref cache of the hub, see pop.mods.pop.ref
+        self._ref_cache = {} if ref_cache is None else ref_cache
 
     def __getattr__(self, item):
         if item in self._attrs:
             return self._attrs[item]
         raise AttributeError(item)
 
+    def __setattr__(self, item, value):
+        if item in self.__dict__.get('_attrs', ()):
+            # Replacing a loaded function, like a monkeypatch does, changes
+            # what refs through this module resolve to
+            self._ref_cache.clear()
+        object.__setattr__(self, item, value)
+
+    def __delattr__(self, item):
+        if item in self._attrs:
+            self._ref_cache.clear()
+        object.__delattr__(self, item)
+
     def __iter__(self):
         keys = sorted(self._funcs)
         ret = []
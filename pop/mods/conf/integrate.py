@@ -50,6 +50,7 @@ def load(
         loader='json',
         logs=True,
         version=True,
+        loop=False,
         ):
     '''
     This function takes a list of python packages to load and look for
@@ -98,6 +99,10 @@ def load(
         vconf = hub.conf.version.CONFIG
         vconf.update(confs[primary])
         confs[primary] = vconf
+    if loop:
+        lpconf = copy.deepcopy(hub.conf.loop.CONFIG)
+        lpconf.update(confs[primary])
+        confs[primary] = lpconf
     _ex_final(confs, final, override, key_to_ref, ops_to_ref)
     _ex_final(globe, final, override, key_to_ref, ops_to_ref, True)
     for opt in ops_to_ref:
@@ -134,5 +139,7 @@ def load(
     if logs:
         log_plugin = hub.OPT[primary].get('log_plugin')
         getattr(hub, f'conf.log.{log_plugin}.setup')(hub.OPT[primary])
+    if loop:
+        hub.conf.loop.setup(hub.OPT[primary])
     if hub.OPT[primary].get('version'):
         hub.conf.version.run(primary)
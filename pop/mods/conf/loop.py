@@ -0,0 +1,35 @@
+'''
+Inject the options used to set up the event loop into conf
+'''
+
+CONFIG = {
+    'loop_policy': {
+        'default': None,
+        'choices': ['auto', 'asyncio', 'uvloop'],
+        'help': 'The event loop to use, auto uses uvloop if it is available. '
+                'The loop policy is left as it is if this is not set',
+        'group': 'Loop Options',
+        },
+    'loop_debug': {
+        'default': False,
+        'action': 'store_true',
+        'help': 'Run the event loop in debug mode and log callbacks that block it',
+        'group': 'Loop Options',
+        },
+    'loop_slow_callback': {
+        'default': 0.1,
+        'type': float,
+        'help': 'In debug mode, log callbacks that block the loop for longer than this many seconds',
+        'group': 'Loop Options',
+        },
+    }
+
+
+def setup(hub, opts):
+    '''
+    Configure the event loop from the loaded options
+    '''
+    hub.pop.loop.configure(
+        policy=opts.get('loop_policy'),
+        debug=opts.get('loop_debug') or None,
+        slow_callback=opts.get('loop_slow_callback'))
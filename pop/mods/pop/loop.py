@@ -4,25 +4,110 @@ The main interface for management of the aio loop
 '''
 # Import python libs
 import asyncio
-import os
 import sys
 import signal
+import logging
 import functools
+import importlib
+import collections
+import multiprocessing
+import concurrent.futures
+
+# Import pop libs
+import pop.exc
 
 __virtualname__ = 'loop'
 
+log = logging.getLogger(__name__)
+
+
+def __init__(hub):
+    '''
+    Track the executors used to run blocking functions
+    '''
+    hub.pop.loop.EXECUTORS = {}
+    hub.pop.loop.EXECUTOR_STATS = {}
+    hub.pop.loop.GROUPS = {}
+    hub.pop.loop.group('default')
+    # Deprecated, the tasks of ensure_future are reaped by their group. They
+    # are only put on this queue when done while the loop is held, or when
+    # FEED_FUT_QUE is set by code that still reads it
+    hub.pop.loop.FUT_QUE = None
+    hub.pop.loop.FEED_FUT_QUE = False
+    hub.pop.loop.HELD = False
+    # The loop policy is only changed when one is configured
+    hub.pop.loop.CONF = {'policy': None, 'debug': None, 'slow_callback': 0.1}
+    hub.pop.loop.POLICY = None
+
 
 def __virtual__(hub):
     return True
 
 
+def configure(hub, policy=None, debug=None, slow_callback=None):
+    '''
+    Set how the loop is created, this needs to be called before the loop is
+    created to change the policy. The policy is auto, asyncio or uvloop,
+    when none is set the current policy is used.
+    With debug set the loop logs every callback that blocks it for longer
+    than slow_callback seconds
+    '''
+    for key, val in (('policy', policy), ('debug', debug), ('slow_callback', slow_callback)):
+        if val is not None:
+            hub.pop.loop.CONF[key] = val
+    if hub.pop.Loop:
+        hub.pop.loop.tune(hub.pop.Loop)
+
+
+def policy(hub, name='auto'):
+    '''
+    Install the named event loop policy and return the name of the policy in
+    use. auto uses uvloop if it is available and leaves the current policy
+    in place otherwise, uvloop falls back to asyncio if it is not available
+    '''
+    if name not in ('auto', 'asyncio', 'uvloop'):
+        raise pop.exc.PopLookupError(f'No loop policy {name}')
+    if name in ('auto', 'uvloop'):
+        try:
+            uvloop = importlib.import_module('uvloop')
+        except ImportError:
+            if name == 'uvloop':
+                log.warning('uvloop is not available, falling back to the asyncio loop')
+                name = 'asyncio'
+            else:
+                hub.pop.loop.POLICY = 'asyncio'
+                return hub.pop.loop.POLICY
+        else:
+            if not isinstance(asyncio.get_event_loop_policy(), uvloop.EventLoopPolicy):
+                asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            hub.pop.loop.POLICY = 'uvloop'
+            return hub.pop.loop.POLICY
+    if type(asyncio.get_event_loop_policy()) is not asyncio.DefaultEventLoopPolicy:  # pylint: disable=unidiomatic-typecheck
+        asyncio.set_event_loop_policy(asyncio.DefaultEventLoopPolicy())
+    hub.pop.loop.POLICY = 'asyncio'
+    return hub.pop.loop.POLICY
+
+
+def tune(hub, loop):
+    '''
+    Apply the debug settings to the loop, debug mode is left as it is
+    unless it has been configured
+    '''
+    if hub.pop.loop.CONF['debug'] is not None:
+        loop.set_debug(hub.pop.loop.CONF['debug'])
+    loop.slow_callback_duration = hub.pop.loop.CONF['slow_callback']
+
+
 def create(hub):
     '''
     Create the loop at hub.pop.Loop
     '''
     if not hub.pop.Loop:
         hub.pop.loop.FUT_QUE = asyncio.Queue()
+        if hub.pop.loop.POLICY is None and hub.pop.loop.CONF['policy'] is not None:
+            hub.pop.loop.policy(hub.pop.loop.CONF['policy'])
         hub.pop.Loop = asyncio.get_event_loop()
+        hub.pop.loop.tune(hub.pop.Loop)
 
 
 def call_soon(hub, ref, *args, **kwargs):
@@ -37,17 +122,177 @@ def call_soon(hub, ref, *args, **kwargs):
 def ensure_future(hub, ref, *args, **kwargs):
     '''
     Schedule a coroutine to be called when the loop has time. This needs
-    to be called after the creation fo the loop. This function also uses
-    the hold system to await the future when it is done making it easy
-    to create a future that will be cleanly awaited in the background.
+    to be called after the creation fo the loop. The future is run in the
+    default task group and reaped when it is done, an exception it raised
+    is passed to the exception handler of the loop. The finished future is
+    also put on the deprecated FUT_QUE while the loop is held or when
+    FEED_FUT_QUE is set.
+    '''
+    task = hub.pop.loop.submit_nowait('default', ref, *args, **kwargs)
+    feed = hub.pop.loop.HELD or hub.pop.loop.FEED_FUT_QUE
+    if task is not None and feed and hub.pop.loop.FUT_QUE is not None:
+        task.add_done_callback(hub.pop.loop.FUT_QUE.put_nowait)
+    return task
+
+
+def group(hub, name, limit=None, queue=None, policy='block'):
+    '''
+    Create or reconfigure the named task group. At most limit tasks of the
+    group run at once and at most queue more wait for a slot, None means no
+    bound. When the group is full the policy decides what happens to a new
+    task, block waits for room and drop discards the task
+    '''
+    if policy not in ('block', 'drop'):
+        raise pop.exc.PopLookupError(f'No task group policy {policy}')
+    grp = hub.pop.loop.GROUPS.get(name)
+    if grp is None:
+        grp = hub.pop.loop.GROUPS[name] = {
+            'tasks': set(),
+            'running': 0,
+            'slots': collections.deque(),
+            'room': collections.deque(),
+            'submitted': 0,
+            'dropped': 0,
+            'done': 0,
+            'failed': 0,
+        }
+    grp.update({'limit': limit, 'queue': queue, 'policy': policy})
+    while grp['slots'] and (limit is None or grp['running'] < limit):
+        grp['running'] += 1
+        _release(grp)
+    return grp
+
+
+def _full(grp):
+    '''
+    Return True if the group can not admit another task
+    '''
+    if grp['limit'] is None or grp['queue'] is None:
+        return False
+    return len(grp['tasks']) >= grp['limit'] + grp['queue']
+
+
+async def submit(hub, name, ref, *args, **kwargs):
+    '''
+    Admit a call to the coroutine function at ref into the named task group
+    and return its task. With the block policy this waits while the group
+    is full, with the drop policy None is returned and the call is dropped
+    '''
+    grp = hub.pop.loop.GROUPS[name]
+    while _full(grp):
+        if grp['policy'] == 'drop':
+            grp['dropped'] += 1
+            return None
+        room = asyncio.get_running_loop().create_future()
+        grp['room'].append(room)
+        try:
+            await room
+        except asyncio.CancelledError:
+            if room.done() and not room.cancelled():
+                _wake(grp['room'])
+            raise
+    return _admit(hub, grp, ref, args, kwargs)
+
+
+def submit_nowait(hub, name, ref, *args, **kwargs):
+    '''
+    Admit a call into the named task group without waiting, None is returned
+    and the call dropped if the group is full whatever the policy is
+    '''
+    grp = hub.pop.loop.GROUPS[name]
+    if _full(grp):
+        grp['dropped'] += 1
+        return None
+    return _admit(hub, grp, ref, args, kwargs)
+
+
+def _admit(hub, grp, ref, args, kwargs):
+    '''
+    Start the task of a call in the group and reap it when it is done
     '''
     fun = getattr(hub, ref)
-    future = asyncio.ensure_future(fun(*args, **kwargs))
+    task = asyncio.ensure_future(_run(grp, fun, args, kwargs))
+    grp['tasks'].add(task)
+    grp['submitted'] += 1
 
-    def callback(fut):
-        hub.pop.loop.FUT_QUE.put_nowait(fut)
-    future.add_done_callback(callback)
-    return future
+    def _reap(fut):
+        grp['tasks'].discard(fut)
+        grp['done'] += 1
+        if not fut.cancelled() and fut.exception() is not None:
+            grp['failed'] += 1
+            fut.get_loop().call_exception_handler({
+                'message': f'Task of {ref} raised an exception',
+                'exception': fut.exception(),
+                'future': fut,
+            })
+        _wake(grp['room'])
+    task.add_done_callback(_reap)
+    return task
+
+
+def _wake(waiters):
+    '''
+    Wake the first of the waiters that is still waiting
+    '''
+    while waiters:
+        waiter = waiters.popleft()
+        if not waiter.done():
+            waiter.set_result(None)
+            return
+
+
+async def _run(grp, fun, args, kwargs):
+    '''
+    Wait for a free slot in the group and run the call in it
+    '''
+    if grp['limit'] is not None and grp['running'] >= grp['limit']:
+        slot = asyncio.get_running_loop().create_future()
+        grp['slots'].append(slot)
+        try:
+            await slot
+        except asyncio.CancelledError:
+            if slot.done() and not slot.cancelled():
+                # The slot was already handed over, pass it on
+                _release(grp)
+            raise
+    else:
+        grp['running'] += 1
+    try:
+        return await fun(*args, **kwargs)
+    finally:
+        _release(grp)
+
+
+def _release(grp):
+    '''
+    Hand the slot of a finished task to the next waiting task, or free it
+    '''
+    if grp['limit'] is None or grp['running'] <= grp['limit']:
+        while grp['slots']:
+            slot = grp['slots'].popleft()
+            if not slot.done():
+                slot.set_result(None)
+                return
+    grp['running'] -= 1
+
+
+def group_stats(hub, name='default'):
+    '''
+    Return the load of the named task group
+    '''
+    grp = hub.pop.loop.GROUPS[name]
+    return {
+        'limit': grp['limit'],
+        'queue': grp['queue'],
+        'policy': grp['policy'],
+        'running': grp['running'],
+        'waiting': len(grp['tasks']) - grp['running'],
+        'blocked': len([room for room in grp['room'] if not room.done()]),
+        'submitted': grp['submitted'],
+        'dropped': grp['dropped'],
+        'done': grp['done'],
+        'failed': grp['failed'],
+    }
 
 
 def start(hub, *coros, hold=False, sigint=None, sigterm=None):
@@ -68,32 +313,110 @@ def start(hub, *coros, hold=False, sigint=None, sigterm=None):
     if hold:
         coros = list(coros)
         coros.append(_holder(hub))
+        hub.pop.loop.HELD = True
     # DO NOT CHANGE THIS CALL TO run_forever! If we do that then the tracebacks
     # do not get resolved.
-    return hub.pop.Loop.run_until_complete(
-            asyncio.gather(*coros)
-            )
+    try:
+        return hub.pop.Loop.run_until_complete(
+                asyncio.gather(*coros)
+                )
+    finally:
+        if hold:
+            hub.pop.loop.HELD = False
+
+
+def executor(hub, kind='thread', max_workers=None):
+    '''
+    Return the executor of the given kind, thread or process, creating it
+    if needed. Passing max_workers sets the size of the executor, an
+    existing executor of another size is shut down and replaced
+    '''
+    if kind not in ('thread', 'process'):
+        raise pop.exc.PopLookupError(f'No executor of kind {kind}')
+    current = hub.pop.loop.EXECUTORS.get(kind)
+    if current is not None:
+        if max_workers is None or max_workers == current._max_workers:
+            return current
+        current.shutdown(wait=False)
+    if kind == 'thread':
+        new = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='pop')
+    else:
+        new = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context('spawn'))
+    hub.pop.loop.EXECUTORS[kind] = new
+    hub.pop.loop.EXECUTOR_STATS.setdefault(kind, {'submitted': 0, 'pending': 0, 'done': 0})
+    return new
+
+
+def offload(hub, kind, func, *args, **kwargs):
+    '''
+    Run the blocking function in the executor of the given kind and return
+    a future for the result, this needs to be called with a running loop
+    '''
+    pool = hub.pop.loop.executor(kind)
+    stats = hub.pop.loop.EXECUTOR_STATS[kind]
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(pool, functools.partial(func, *args, **kwargs))
+    stats['submitted'] += 1
+    stats['pending'] += 1
+
+    def callback(fut):
+        stats['pending'] -= 1
+        stats['done'] += 1
+    future.add_done_callback(callback)
+    return future
+
+
+def executor_stats(hub, kind='thread'):
+    '''
+    Return the size and queue depth of the executor of the given kind
+    '''
+    pool = hub.pop.loop.EXECUTORS.get(kind)
+    stats = hub.pop.loop.EXECUTOR_STATS.get(kind, {'submitted': 0, 'pending': 0, 'done': 0})
+    workers = pool._max_workers if pool else 0
+    return {
+        'workers': workers,
+        'running': min(stats['pending'], workers),
+        'queued': max(0, stats['pending'] - workers),
+        'pending': stats['pending'],
+        'submitted': stats['submitted'],
+        'done': stats['done']}
 
 
 async def _holder(hub):
     '''
     Just a sleeping while loop to hold the loop open while it runs until
-    complete
+    complete, the finished futures of the deprecated FUT_QUE are dropped
     '''
     while True:
-        future = await hub.pop.loop.FUT_QUE.get()
-        await future
+        await hub.pop.loop.FUT_QUE.get()
 
 
 async def await_futures(hub):
     '''
-    Scan over the futures that have completed and manually await them.
-    This function is used to clean up futures when the loop is not opened
-    up with hold=True so that ensured futures can be cleaned up on demand
+    Clean up the futures that have completed, the tasks of the task groups
+    are reaped as they finish so this only empties the deprecated FUT_QUE.
+    This does not wait for the tasks that are still running, see join
     '''
-    while not hub.pop.loop.FUT_QUE.empty():
-        future = await hub.pop.loop.FUT_QUE.get()
-        await future
+    que = hub.pop.loop.FUT_QUE
+    while que is not None and not que.empty():
+        que.get_nowait()
+
+
+async def join(hub, name=None):
+    '''
+    Wait for the tasks of the named task group, or of every group, to be
+    done, including the tasks started while waiting
+    '''
+    groups = [hub.pop.loop.GROUPS[name]] if name else list(hub.pop.loop.GROUPS.values())
+    while True:
+        tasks = [task for grp in groups for task in grp['tasks']]
+        if not tasks:
+            break
+        await asyncio.wait(tasks)
 
 
 async def kill(hub, wait=0):
@@ -108,7 +431,7 @@ async def kill(hub, wait=0):
         await asyncio.sleep(1)
 
 
-async def as_yielded(hub, gens):
+def as_yielded(hub, gens, maxsize=64, ordered=False):
     '''
     Concurrently run multiple async generators and yield the next yielded
     value from the soonest yielded generator.
@@ -121,32 +444,98 @@ async def as_yielded(hub, gens):
         gens = []
         for n in range(10):
             gens.append(many())
-        async for y in as_yielded(gens):
+        async for y in hub.pop.loop.as_yielded(gens):
             print(y)
+
+    At most maxsize values are buffered before the generators are held
+    back. With ordered the generators still run concurrently but all of the
+    values of the first generator are yielded before those of the next one,
+    each generator then buffers up to maxsize values of its own.
+    An exception raised by a generator is raised to the consumer, and when
+    the consumer stops early the generators still running are cancelled
     '''
-    fin = os.urandom(32)
-    que = asyncio.Queue()
-    fs = []
-    to_clean = []
-    async def _yield(gen):
-        async for comp in gen:
-            await que.put(comp)
-    async def _ensure(coros):
-        for f in asyncio.as_completed(coros):
-            await f
-    async def _set_done():
-        await que.put(fin)
-    def _done(future):
-        to_clean.append(asyncio.ensure_future(_set_done()))
-    coros = []
-    for gen in gens:
-        coros.append(_yield(gen))
-    f = asyncio.ensure_future(_ensure(coros))
-    f.add_done_callback(_done)
-    while True:
-        ret = await que.get()
-        if ret == fin:
-            break
-        yield ret
-    for c in to_clean:
-        await c
+    return _merge(gens, maxsize, ordered, None)
+
+
+def as_batched(hub, gens, maxsize=64, ordered=False, max_items=0):
+    '''
+    Like as_yielded, but yield lists of all of the values that are ready,
+    of at most max_items values if it is set
+    '''
+    return _merge(gens, maxsize, ordered, max_items)
+
+
+# Marks a generator that is exhausted in the queue of as_yielded
+_DONE = object()
+
+
+class _Raised:
+    '''
+    Carries the exception of a generator through the queue of as_yielded
+    '''
+    __slots__ = ('exc',)
+
+    def __init__(self, exc):
+        self.exc = exc
+
+
+async def _produce(gen, que):
+    '''
+    Put the values of the generator on the queue, then the done marker
+    '''
+    try:
+        async for item in gen:
+            await que.put(item)
+        await que.put(_DONE)
+    except Exception as exc:  # pylint: disable=broad-except
+        await que.put(_Raised(exc))
+    finally:
+        aclose = getattr(gen, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+
+async def _merge(gens, maxsize, ordered, batch):
+    '''
+    Run the generators and yield their values, one at a time or in lists
+    when batch is not None
+    '''
+    gens = list(gens)
+    if ordered:
+        queues = [asyncio.Queue(maxsize) for _ in gens]
+        plan = [(que, 1) for que in queues]
+    else:
+        queues = [asyncio.Queue(maxsize)] * len(gens)
+        plan = [(queues[0], len(gens))] if gens else []
+    tasks = [asyncio.ensure_future(_produce(gen, que)) for gen, que in zip(gens, queues)]
+    try:
+        for que, remaining in plan:
+            while remaining:
+                item = await que.get()
+                if batch is None:
+                    if item is _DONE:
+                        remaining -= 1
+                    elif type(item) is _Raised:  # pylint: disable=unidiomatic-typecheck
+                        raise item.exc
+                    else:
+                        yield item
+                    continue
+                items = []
+                while True:
+                    if item is _DONE:
+                        remaining -= 1
+                    elif type(item) is _Raised:  # pylint: disable=unidiomatic-typecheck
+                        if items:
+                            yield items
+                        raise item.exc
+                    else:
+                        items.append(item)
+                    if not remaining or que.empty() or (batch and len(items) >= batch):
+                        break
+                    item = que.get_nowait()
+                if items:
+                    yield items
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
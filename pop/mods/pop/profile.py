@@ -0,0 +1,69 @@
+'''
+Profile the functions on the hub. While profiling is on every call of a
+function on the hub is timed, when it is off the calls are not touched.
+Profiling is process wide, it covers the calls on every hub.
+'''
+# Import pop libs
+import pop.exc
+import pop.profile
+import pop.contract
+
+
+def __init__(hub):
+    '''
+    The profiler keeps what it recorded when it is stopped
+    '''
+    hub.pop.profile.PROFILER = pop.profile.Profiler(ignore=('pop.profile',))
+
+
+def start(hub, clear=True):
+    '''
+    Start profiling the calls of the functions on the hub
+    '''
+    if clear:
+        hub.pop.profile.PROFILER.clear()
+    pop.contract.PROFILER = hub.pop.profile.PROFILER
+
+
+def stop(hub):
+    '''
+    Stop profiling and return the stats that were recorded
+    '''
+    if pop.contract.PROFILER is hub.pop.profile.PROFILER:
+        pop.contract.PROFILER = None
+    return hub.pop.profile.stats()
+
+
+def running(hub):
+    '''
+    Return True if this hub is profiling
+    '''
+    return pop.contract.PROFILER is hub.pop.profile.PROFILER
+
+
+def stats(hub):
+    '''
+    Return a dict of the function references to their calls, cumtime,
+    selftime and exceptions
+    '''
+    return hub.pop.profile.PROFILER.data()
+
+
+def dump(hub, fmt='table', path=None, **kwargs):
+    '''
+    Return the recorded stats formatted as a table, json or collapsed stacks
+    for flamegraph tools. If a path is passed the stats are written to it.
+    The table accepts the column to sort by and a limit on the rows
+    '''
+    if fmt == 'table':
+        out = hub.pop.profile.PROFILER.table(**kwargs)
+    elif fmt == 'json':
+        out = hub.pop.profile.PROFILER.json()
+    elif fmt == 'collapsed':
+        out = hub.pop.profile.PROFILER.collapsed()
+    else:
+        raise pop.exc.PopLookupError(f'No profile format {fmt}')
+    if path:
+        with open(path, 'w') as fh:
+            fh.write(out + '\n')
+    return out
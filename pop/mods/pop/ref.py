@@ -1,6 +1,15 @@
 '''
 Used to resolve resolutions to paths on the hub
+
+Resolved string refs that lead through subs and loaded modules are cached on
+the hub, the cache is cleared when subs are added, removed, reloaded or
+extended, and when a loaded module, sub or function is replaced by setting an
+attribute.
 '''
+# Import pop libs
+import pop.hub
+import pop.loader
+import pop.contract
 
 
 def last(hub, ref):
@@ -8,6 +17,8 @@ def last(hub, ref):
     Takes a string that references the desired ref and returns the last object
     called out in that ref
     '''
+    if isinstance(ref, str) and ref in hub._ref_cache:
+        return hub._ref_cache[ref][-1]
     return hub.pop.ref.path(ref)[-1]
 
 
@@ -15,14 +26,36 @@ def path(hub, ref):
     '''
     Retuns a list of references up to the named ref
     '''
-    ret = [hub]
-    if isinstance(ref, str):
-        ref = ref.split('.')
-    for chunk in ref:
+    if isinstance(ref, str) and ref in hub._ref_cache:
+        return list(hub._ref_cache[ref])
+    ret = [hub._root]
+    chunks = ref.split('.') if isinstance(ref, str) else ref
+    for chunk in chunks:
         ret.append(getattr(ret[-1], chunk))
+    if isinstance(ref, str) and _cacheable(ret):
+        hub._ref_cache[ref] = tuple(ret)
     return ret
 
 
+def _cacheable(path_):
+    '''
+    Only paths through subs and loaded modules to a sub, module or function
+    are stable until the subs change, anything else could be replaced at any
+    time
+    '''
+    for obj in path_[1:-1]:
+        if not isinstance(obj, (pop.hub.Sub, pop.loader.LoadedMod)):
+            return False
+    return isinstance(path_[-1], (pop.hub.Sub, pop.loader.LoadedMod, pop.contract.Contracted))
+
+
+def clear(hub):
+    '''
+    Clear the cache of resolved refs
+    '''
+    hub._ref_cache.clear()
+
+
 def create(hub, ref, obj):
     '''
     Create an attribute at a given target using just a ref string and the
@@ -33,6 +66,7 @@ def create(hub, ref, obj):
         create the given object on the hub
     :param obj: The object to store at the given reference point
     '''
+    hub.pop.ref.clear()
     if '.' not in ref:
         setattr(hub, ref, obj)
         return
@@ -60,6 +60,7 @@ def add(hub,
             stop_on_failures)
     root._subs[subname]._sub_init(init)
     root._iter_subs = sorted(root._subs.keys())
+    hub.pop.ref.clear()
 
 
 def remove(hub, subname):
@@ -73,6 +74,7 @@ def remove(hub, subname):
             if hasattr(mod, 'shutdown'):
                 mod.shutdown()
         hub._remove_subsystem(subname)
+        hub.pop.ref.clear()
 
 
 def load_all(hub, subname):
@@ -107,6 +109,16 @@ def load_subdirs(hub, sub, recurse=False):
     '''
     Given a sub, load all subdirectories found under the sub into a lower namespace
     '''
+    _load_subdirs(hub, sub, recurse)
+    if hub._scan_cache:
+        # Write the scan data of all of the new subs out at once
+        hub._scan_cache.dump()
+
+
+def _load_subdirs(hub, sub, recurse):
+    '''
+    Load the subdirectories of the sub, and theirs if recurse is set
+    '''
     dirs = hub.pop.sub.get_dirs(sub)
     roots = {}
     for dir_ in dirs:
@@ -137,7 +149,7 @@ def load_subdirs(hub, sub, recurse=False):
                 mod_basename=sub._mod_basename,
                 stop_on_failures=sub._stop_on_failures)
         if recurse:
-            hub.pop.sub.load_subdirs(getattr(sub, name), recurse)
+            _load_subdirs(hub, getattr(sub, name), recurse)
 
 
 def reload(hub, subname):
@@ -150,6 +162,7 @@ def reload(hub, subname):
     if hasattr(hub, subname):
         sub = getattr(hub, subname)
         sub._prepare()
+        hub.pop.ref.clear()
         return True
     else:
         return False
@@ -178,3 +191,4 @@ def extend(
     if contracts_static:
         sub._contracts_static.extend(pop.hub.ex_path(contracts_static))
     sub._prepare()
+    hub.pop.ref.clear()
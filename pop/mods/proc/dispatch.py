@@ -0,0 +1,82 @@
+'''
+Dispatch policies used to choose which worker in a pool runs a call. The
+policy for a pool is set when the pool is created, any function in this sub
+that takes the pool name and an optional key can be used as a policy.
+'''
+# Import python libs
+import bisect
+import hashlib
+import random
+
+# The number of points each worker gets on the affinity hash ring
+VNODES = 64
+
+
+def round_robin(hub, worker_name, key=None):  # pylint: disable=unused-argument
+    '''
+    Cycle over the workers in order
+    '''
+    return next(hub.proc.WorkersIter[worker_name])
+
+
+def least_loaded(hub, worker_name, key=None):  # pylint: disable=unused-argument
+    '''
+    Choose the worker with the fewest calls in flight, ties are broken at
+    random
+    '''
+    workers = hub.proc.Workers[worker_name]
+    low = min(worker['inflight'] for worker in workers.values())
+    return random.choice([ind for ind, worker in workers.items() if worker['inflight'] == low])
+
+
+def p2c(hub, worker_name, key=None):  # pylint: disable=unused-argument
+    '''
+    Power of two choices, pick two workers at random and choose the one with
+    fewer calls in flight
+    '''
+    workers = hub.proc.Workers[worker_name]
+    inds = list(workers)
+    if len(inds) < 2:
+        return inds[0]
+    first, second = random.sample(inds, 2)
+    if workers[first]['inflight'] <= workers[second]['inflight']:
+        return first
+    return second
+
+
+def affinity(hub, worker_name, key=None):
+    '''
+    Send all calls with the same key to the same worker, using a consistent
+    hash so that few keys move when workers are added or removed. Calls
+    without a key go to the least loaded worker
+    '''
+    if key is None:
+        return hub.proc.dispatch.least_loaded(worker_name)
+    workers = hub.proc.Workers[worker_name]
+    track = hub.proc.WorkersTrack[worker_name]
+    ring = track.get('ring')
+    if ring is None or ring['inds'] != set(workers):
+        ring = _mk_ring(workers)
+        track['ring'] = ring
+    pos = bisect.bisect(ring['hashes'], _hash(key)) % len(ring['hashes'])
+    return ring['owners'][pos]
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+
+def _mk_ring(workers):
+    '''
+    Build the consistent hash ring for the given workers
+    '''
+    points = []
+    for ind in workers:
+        for vnode in range(VNODES):
+            points.append((_hash(f'{ind}-{vnode}'), ind))
+    points.sort()
+    return {
+        'inds': set(workers),
+        'hashes': [point[0] for point in points],
+        'owners': [point[1] for point in points],
+        }
@@ -0,0 +1,103 @@
+'''
+The fork server loads the subs for a pool onto a template hub once and then
+forks every worker of the pool from it. The workers share the memory of the
+loaded modules copy-on-write and skip the interpreter startup and imports.
+
+The fork server does not run an event loop, so it is safe to fork from.
+'''
+# Import python libs
+import os
+import sys
+import json
+import signal
+import traceback
+
+# Import third party libs
+import msgpack
+
+
+def start(hub, sock_dir, ret_ref, ctl_fd):
+    '''
+    This function is called by the startup script to create the fork server.
+    The first message read from stdin is the list of subs to load, every
+    message after that is a worker to fork. Exits are reported over the
+    control pipe.
+    '''
+    children = {}
+
+    def reap(signum, frame):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            ind = children.pop(pid, None)
+            if ind is None:
+                continue
+            msg = {'exit': os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status),
+                   'ind': ind,
+                   'pid': pid}
+            try:
+                os.write(ctl_fd, json.dumps(msg).encode() + b'\n')
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGCHLD, reap)
+    for cmd in hub.proc.fork.cmds():
+        if 'ind' not in cmd:
+            hub.proc.worker.preload(cmd['subs'])
+            continue
+        pid = os.fork()
+        if not pid:
+            hub.proc.fork.child(sock_dir, ret_ref, ctl_fd, cmd)
+        children[pid] = cmd['ind']
+    # The creating process is gone, take the workers down with it
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+
+def cmds(hub):
+    '''
+    Yield the msgpack messages read from stdin until it is closed
+    '''
+    unpacker = msgpack.Unpacker(raw=False)
+    while True:
+        data = os.read(sys.stdin.fileno(), 65536)
+        if not data:
+            return
+        unpacker.feed(data)
+        yield from unpacker
+
+
+def child(hub, sock_dir, ret_ref, ctl_fd, cmd):
+    '''
+    Run the worker in the forked child, this never returns
+    '''
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    # Only the fork server reads the commands
+    null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null, sys.stdin.fileno())
+    os.close(null)
+    code = 0
+    try:
+        hub.proc.worker.start(
+            sock_dir,
+            str(cmd['ind']),
+            cmd['ref'],
+            ret_ref,
+            ctl_fd,
+            cmd.get('shm'),
+            cmd.get('preload'),
+            cmd.get('warmup'),
+            cmd.get('shm_ext'))
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        os._exit(code)
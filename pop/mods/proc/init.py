@@ -5,53 +5,266 @@ coroutines.
 # Import python libs
 import os
 import sys
+import json
+import time
 import atexit
+import signal
 import itertools
 import asyncio
 import subprocess
+import struct
+
 # Import third party libs
 import msgpack
 
+# Import pop libs
+import pop.exc
+
 
 def __init__(hub):
     '''
     Create constants used by the client and server side of procs
     '''
-    hub.proc.DELIM = b'd\xff\xcfCO)\xfe='
+    # Frame header: body length, flag and request id
+    hub.proc.HEADER = struct.Struct('!IcI')
+    hub.proc.R_FLAG = b'R'
     hub.proc.D_FLAG = b'D'
     hub.proc.I_FLAG = b'I'
+    # Sent by the caller to cancel a request and to grant more items to a
+    # generator
+    hub.proc.C_FLAG = b'C'
+    hub.proc.K_FLAG = b'K'
+    # The number of items a generator can send before the caller consumes them
+    hub.proc.GEN_CREDIT = 32
     hub.proc.Workers = {}
     hub.proc.WorkersIter = {}
     hub.proc.WorkersTrack = {}
+    # Seconds to wait before respawning a dead worker, doubled every time
+    # it dies again within BACKOFF_RESET seconds of starting
+    hub.proc.BACKOFF_BASE = 0.1
+    hub.proc.BACKOFF_MAX = 30
+    hub.proc.BACKOFF_RESET = 60
+
+
+def _get_cmd(hub):
+    '''
+    Return the command to execute that will start up the worker, the
+    arguments of the worker are read from stdin
+    '''
+    code = 'import sys; '
+    code += 'import pop.hub; '
+    code += 'hub = pop.hub.Hub(); '
+    code += 'hub.pop.sub.add("pop.mods.proc"); '
+    code += 'hub.proc.worker.start_stdin()'
+    return [sys.executable, '-c', code]
 
 
-def _get_cmd(hub, ind, ref, ret_ref, sock_dir):
+def _get_fork_cmd(hub, ret_ref, sock_dir, ctl_fd):
     '''
-    Return the shell command to execute that will start up the worker
+    Return the command to execute that will start up the fork server
     '''
     code = 'import sys; '
     code += 'import pop.hub; '
     code += 'hub = pop.hub.Hub(); '
     code += 'hub.pop.sub.add("pop.mods.proc"); '
-    code += f'hub.proc.worker.start("{sock_dir}", "{ind}", "{ref}", "{ret_ref}")'
-    cmd = f'{sys.executable} -c \'{code}\''
-    return cmd
+    code += f'hub.proc.fork.start("{sock_dir}", "{ret_ref}", {ctl_fd})'
+    return [sys.executable, '-c', code]
+
+
+def _write_cmd(hub, proc, cmd):
+    '''
+    Send the arguments to a worker or fork server over its stdin, they are
+    msgpack encoded the same way as the calls sent to the workers
+    '''
+    proc.stdin.write(msgpack.dumps(cmd, use_bin_type=True))
 
 
-def mk_proc(hub, ind, workers, ret_ref, sock_dir):
+def _mk_worker(hub, name, ind):
     '''
-    Create the process and add it to the passed in workers dict at the
-    specified index
+    Add the data for a new worker to the named pool, the ready future
+    is resolved with the pid of the worker once its socket is listening
     '''
     ref = os.urandom(3).hex() + '.sock'
-    workers[ind] = {'ref': ref}
-    workers[ind]['path'] = os.path.join(sock_dir, ref)
-    cmd = _get_cmd(hub, ind, ref, ret_ref, sock_dir)
-    workers[ind]['proc'] = subprocess.Popen(cmd, shell=True)
-    workers[ind]['pid'] = workers[ind]['proc'].pid
+    worker = {'ref': ref, 'inflight': 0, 'shm': hub.proc.WorkersTrack[name]['shm']}
+    worker['path'] = os.path.join(hub.proc.WorkersTrack[name]['sock_dir'], ref)
+    worker['ready'] = asyncio.get_event_loop().create_future()
+    hub.proc.Workers[name][ind] = worker
+    return worker
+
+
+def mk_proc(hub, name, ind):
+    '''
+    Create the process and add it to the named pool at the specified index
+    '''
+    track = hub.proc.WorkersTrack[name]
+    worker = _mk_worker(hub, name, ind)
+    r_fd, w_fd = os.pipe()
+    cmd = {
+        'sock_dir': track['sock_dir'],
+        'ind': str(ind),
+        'ref': worker['ref'],
+        'ret_ref': track['ret_ref'],
+        'ready_fd': w_fd,
+        'shm': track['shm'],
+        'shm_ext': hub.proc.shm.EXT,
+        'preload': track['preload'] + track['subs'],
+        'warmup': track['warmup']}
+    worker['proc'] = subprocess.Popen(_get_cmd(hub), stdin=subprocess.PIPE, pass_fds=(w_fd,))
+    worker['pid'] = worker['proc'].pid
+    os.close(w_fd)
+    _write_cmd(hub, worker['proc'], cmd)
+    worker['proc'].stdin.close()
+    # The pipe reader is only weakly held by the loop, keep the task alive
+    worker['watch'] = asyncio.ensure_future(hub.proc.init.watch(name, ind, r_fd))
 
 
-async def pool(hub, num, name='Workers', callback=None, sock_dir=None):
+def mk_fork(hub, name, ind):
+    '''
+    Ask the fork server of the named pool to fork a new worker from the
+    template hub and add it to the pool at the specified index
+    '''
+    track = hub.proc.WorkersTrack[name]
+    worker = _mk_worker(hub, name, ind)
+    cmd = {
+        'ind': ind,
+        'ref': worker['ref'],
+        'shm': worker['shm'],
+        'shm_ext': hub.proc.shm.EXT,
+        'preload': track['subs'],
+        'warmup': track['warmup']}
+    _write_cmd(hub, track['forkserver']['proc'], cmd)
+
+
+def mk_forkserver(hub, name):
+    '''
+    Start the fork server process for the named pool, it preloads the subs
+    of the pool onto a template hub and forks every worker of the pool from
+    it so that the loaded modules are shared copy-on-write
+    '''
+    track = hub.proc.WorkersTrack[name]
+    r_fd, w_fd = os.pipe()
+    cmd = _get_fork_cmd(hub, track['ret_ref'], track['sock_dir'], w_fd)
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, pass_fds=(w_fd,), bufsize=0)
+    os.close(w_fd)
+    _write_cmd(hub, proc, {'subs': track['preload']})
+    track['forkserver'] = {'proc': proc, 'closed': False}
+    # The pipe reader is only weakly held by the loop, keep the task alive
+    track['forkserver']['watch'] = asyncio.ensure_future(
+            hub.proc.init.watch_forkserver(name, r_fd))
+
+
+async def _lines(hub, r_fd):
+    '''
+    Yield the control messages written to the given pipe until it is closed
+    '''
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader),
+            os.fdopen(r_fd, 'rb', 0))
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            yield json.loads(line)
+    finally:
+        transport.close()
+
+
+async def watch(hub, name, ind, r_fd):
+    '''
+    Watch an executed worker over its pipe. The worker reports that it is
+    ready over the pipe and holds it open until it exits
+    '''
+    worker = hub.proc.Workers[name][ind]
+    async for msg in _lines(hub, r_fd):
+        if 'ready' in msg:
+            hub.proc.init.ready(worker)
+    code = await asyncio.get_event_loop().run_in_executor(None, worker['proc'].wait)
+    hub.proc.init.died(name, ind, worker, code)
+
+
+async def watch_forkserver(hub, name, r_fd):
+    '''
+    Watch the workers of a fork server, they report that they are ready
+    over the pipe and the fork server reports when they exit
+    '''
+    workers = hub.proc.Workers[name]
+    async for msg in _lines(hub, r_fd):
+        ind = int(msg['ind'])
+        worker = workers.get(ind)
+        if worker is None:
+            continue
+        if 'ready' in msg:
+            worker['pid'] = msg['pid']
+            hub.proc.init.ready(worker)
+        elif 'exit' in msg and worker.get('pid') == msg['pid']:
+            hub.proc.init.died(name, ind, worker, msg['exit'])
+    # The fork server and all of its workers are gone
+    hub.proc.WorkersTrack[name]['forkserver']['closed'] = True
+    for ind, worker in list(workers.items()):
+        hub.proc.init.died(name, ind, worker, None)
+
+
+def ready(hub, worker):
+    '''
+    Mark the worker as ready to take calls
+    '''
+    if not worker['ready'].done():
+        worker['started'] = time.monotonic()
+        worker['ready'].set_result(worker['pid'])
+
+
+def died(hub, name, ind, worker, code):
+    '''
+    Handle the exit of a worker. A worker that exits before it is ready
+    failed to start, a running worker is respawned if the pool restarts
+    workers. The calls in flight on the worker fail when its connection is
+    lost
+    '''
+    if 'returncode' in worker:
+        return
+    worker['returncode'] = code
+    if not worker['ready'].done():
+        worker['ready'].set_exception(
+            pop.exc.ProcessNotStarted(f'Worker {ind} of {name} exited before it was ready'))
+        return
+    track = hub.proc.WorkersTrack[name]
+    if not track['restart'] or (track['forkserver'] or {}).get('closed'):
+        return
+    if hub.proc.Workers[name].get(ind) is worker:
+        worker['maintain'] = asyncio.ensure_future(hub.proc.init.maintain(name, ind))
+
+
+async def spawn(hub, name, ind):
+    '''
+    Start a worker at the given index of the named pool and wait for it to
+    be ready, the subs that have been added to the pool are loaded on it
+    before it is ready
+    '''
+    if hub.proc.WorkersTrack[name]['forkserver']:
+        hub.proc.init.mk_fork(name, ind)
+    else:
+        hub.proc.init.mk_proc(name, ind)
+    worker = hub.proc.Workers[name][ind]
+    await worker['ready']
+    return worker
+
+
+async def pool(
+        hub,
+        num,
+        name='Workers',
+        callback=None,
+        sock_dir=None,
+        policy='round_robin',
+        fork=False,
+        subs=None,
+        restart=True,
+        shm=None,
+        warmup=None,
+        timeout=None):
     '''
     Create a new local pool of process based workers
 
@@ -60,47 +273,105 @@ async def pool(hub, num, name='Workers', callback=None, sock_dir=None):
         store the worker pool, defaults to `hub.pop.proc.Workers`
     :param callback: The pop ref to call when the process communicates
         back
+    :param policy: The name of the function in hub.proc.dispatch used to
+        choose the worker for each call: round_robin, least_loaded, p2c or
+        affinity
+    :param fork: Start a fork server that loads the subs once and fork the
+        workers from it instead of executing a fresh interpreter for each
+    :param subs: A list of subs to load on every worker when it starts, all
+        of their modules are loaded up front. Each is a pypath or a dict of
+        kwargs for hub.pop.sub.add
+    :param warmup: A list of functions to call on every worker when it
+        starts, the worker is not ready until they return. Each is a ref or
+        a dict with the ref, args and kwargs
+    :param restart: Respawn workers that die, the number of restarts of
+        each worker is kept in the restarts dict of the pool tracker
+    :param shm: Send bytes like arguments and returns of at least this many
+        bytes through shared memory instead of the socket, they are received
+        as a memoryview
+    :param timeout: The default number of seconds that a call to the pool
+        can take
     '''
+    if not hasattr(hub.proc.dispatch, policy):
+        raise pop.exc.PopLookupError(f'No proc dispatch policy named {policy}')
     ret_ref = os.urandom(3).hex() + '.sock'
     ret_sock_path = os.path.join(sock_dir, ret_ref)
     if not hub.proc.Tracker:
         hub.proc.init.mk_tracker()
+    subs = [_sub_spec(hub, sub) for sub in subs or []]
+    warmup = [_call_spec(hub, call) for call in warmup or []]
     workers = {}
     if callback:
         await asyncio.start_unix_server(
                 hub.proc.init.ret_work(callback),
                 path=ret_sock_path)
-    for ind in range(num):
-        hub.proc.init.mk_proc(ind, workers, ret_ref, sock_dir)
-    w_iter = itertools.cycle(workers)
     hub.proc.Workers[name] = workers
-    hub.proc.WorkersIter[name] = w_iter
     hub.proc.WorkersTrack[name] = {
         'subs': [],
+        'preload': subs,
+        'warmup': warmup,
         'ret_ref': ret_ref,
-        'sock_dir': sock_dir}
-    up = set()
-    while True:
-        for ind in workers:
-            if os.path.exists(workers[ind]['path']):
-                up.add(ind)
-        if len(up) == num:
-            break
-        await asyncio.sleep(0.01)
-    # TODO: This seems to be spawning extra procs, this should be fixed
-    #asyncio.ensure_future(hub.proc.init.maintain(name))
+        'sock_dir': sock_dir,
+        'policy': policy,
+        'forkserver': None,
+        'restart': restart,
+        'restarts': {},
+        'shm': shm,
+        'timeout': timeout}
+    if fork:
+        hub.proc.init.mk_forkserver(name)
+    for ind in range(num):
+        if fork:
+            hub.proc.init.mk_fork(name, ind)
+        else:
+            hub.proc.init.mk_proc(name, ind)
+    hub.proc.WorkersIter[name] = itertools.cycle(sorted(workers))
+    await asyncio.gather(*[worker['ready'] for worker in workers.values()])
+
+
+def _sub_spec(hub, sub):
+    '''
+    Normalize a sub passed to the pool into the args and kwargs for
+    hub.pop.sub.add
+    '''
+    if isinstance(sub, str):
+        return {'args': [sub], 'kwargs': {}}
+    return {'args': [], 'kwargs': dict(sub)}
+
+
+def _call_spec(hub, call):
+    '''
+    Normalize a warmup call passed to the pool into the ref, args and kwargs
+    '''
+    if isinstance(call, str):
+        return {'ref': call, 'args': [], 'kwargs': {}}
+    return {'ref': call['ref'], 'args': list(call.get('args', [])), 'kwargs': dict(call.get('kwargs', {}))}
 
 
-async def maintain(hub, name):
+async def maintain(hub, name, ind):
     '''
-    Keep an eye on these processes
+    Respawn the dead worker at the given index of the named pool. Workers
+    that keep dying soon after starting are respawned with an exponential
+    backoff
     '''
+    track = hub.proc.WorkersTrack[name]
     workers = hub.proc.Workers[name]
     while True:
-        for ind, data in workers.items():
-            if not data['proc'].poll():
-                hub.proc.init.mk_proc(ind, workers)
-        await asyncio.sleep(2)
+        dead = workers[ind]
+        streak = dead.get('streak', 0)
+        if 'started' in dead and time.monotonic() - dead['started'] > hub.proc.BACKOFF_RESET:
+            streak = 0
+        await asyncio.sleep(min(hub.proc.BACKOFF_MAX, hub.proc.BACKOFF_BASE * 2 ** streak))
+        track['restarts'][ind] = track['restarts'].get(ind, 0) + 1
+        try:
+            worker = await hub.proc.init.spawn(name, ind)
+        except (pop.exc.ProcessNotStarted, OSError, asyncio.IncompleteReadError):
+            if (track['forkserver'] or {}).get('closed'):
+                return
+            workers[ind]['streak'] = streak + 1
+            continue
+        worker['streak'] = streak + 1
+        return worker
 
 
 def mk_tracker(hub):
@@ -115,11 +386,62 @@ def mk_tracker(hub):
 
 def clean(hub):
     '''
-    Clean up the processes registered in the tracker
+    Clean up the processes registered in the tracker. The tasks reading the
+    worker connections and watching the workers are cancelled, and if the
+    loop is not running it is run until they are done
     '''
+    tasks = []
     for name, workers in hub.proc.Workers.items():
+        hub.proc.WorkersTrack[name]['restart'] = False
         for ind in workers:
-            workers[ind]['proc'].terminate()
+            if 'proc' in workers[ind]:
+                workers[ind]['proc'].terminate()
+            elif 'pid' in workers[ind]:
+                try:
+                    os.kill(workers[ind]['pid'], signal.SIGTERM)
+                except OSError:
+                    pass
+            tasks.extend(_worker_tasks(workers[ind]))
+        server = hub.proc.WorkersTrack[name]['forkserver']
+        if server:
+            server['proc'].terminate()
+            tasks.append(server.get('watch'))
+    _reap(tasks)
+
+
+def _worker_tasks(worker):
+    '''
+    Close the connection to the worker and return the tasks that serve it
+    '''
+    tasks = [worker.get('watch'), worker.get('maintain')]
+    fut = worker.get('conn')
+    if fut is None:
+        return tasks
+    if not fut.done():
+        tasks.append(fut)
+    elif not fut.cancelled() and fut.exception() is None:
+        conn = fut.result()
+        conn['closed'] = True
+        if not conn['writer'].transport.is_closing():
+            conn['writer'].close()
+        tasks.append(conn['task'])
+    return tasks
+
+
+def _reap(tasks):
+    '''
+    Cancel the tasks and wait for them to finish if the loop is not running
+    '''
+    tasks = [task for task in tasks if task is not None and not task.done()]
+    if not tasks:
+        return
+    loop = tasks[0].get_loop()
+    if loop.is_closed():
+        return
+    for task in tasks:
+        task.cancel()
+    if not loop.is_running():
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
 
 
 def ret_work(hub, callback):
@@ -127,13 +449,8 @@ def ret_work(hub, callback):
         '''
         Process the incoming work
         '''
-        inbound = await reader.readuntil(hub.proc.DELIM)
-        inbound = inbound[:-len(hub.proc.DELIM)]
-        payload = msgpack.loads(inbound, raw=False)
+        rid, _, payload = await hub.proc.wire.recv(reader)
         ret = await callback(payload)
-        ret = msgpack.dumps(ret, use_bin_type=True)
-        ret += hub.proc.DELIM
-        writer.write(ret)
-        await writer.drain()
+        await hub.proc.wire.send(writer, asyncio.Lock(), rid, hub.proc.D_FLAG, ret)
         writer.close()
     return work
@@ -2,56 +2,43 @@
 Execute functions or load subs on the workers in the named worker pool
 '''
 # import python libs
+import time
 import asyncio
-import os
-# Import third party libs
-import msgpack
+import itertools
 
+# Import pop libs
+import pop.exc
 
-async def add_sub(hub, worker_name, *args, **kwargs):
+
+async def add_sub(hub, worker_name, *args, _timeout=None, _concurrency=None, **kwargs):
     '''
     Tell all of the worker in the named pool to load the given sub,
 
-    This function takes all of the same arguments as hub.pop.sub.add
+    This function takes all of the same arguments as hub.pop.sub.add, the
+    _timeout and _concurrency arguments are the same as for
+    hub.proc.run.pub
     '''
-    ret = {}
-    workers = hub.proc.Workers[worker_name]
-    for ind in workers:
-        payload = {'fun': 'sub', 'args': args, 'kwargs': kwargs}
-        # TODO: Make these futures to the run at the same time
-        async for chunk in hub.proc.run.send(workers[ind], payload):
-            ret[ind] = chunk
+    payload = {'fun': 'sub', 'args': args, 'kwargs': kwargs}
+    ret = await hub.proc.run.fan_out(worker_name, payload, _timeout, _concurrency)
     hub.proc.WorkersTrack[worker_name]['subs'].append({'args': args, 'kwargs': kwargs})
     return ret
 
 
 async def add_proc(hub, worker_name):
     '''
-    Add a single process to the worker pool, also make sure that
+    Add a single process to the worker pool, also make sure that all of the
+    subs added to the pool are loaded on it
     '''
-    # grab and extrapolate the data we need
-    ret_ref = hub.proc.WorkersTrack[worker_name]['ret_ref']
-    sock_dir = hub.proc.WorkersTrack[worker_name]['sock_dir']
     workers = hub.proc.Workers[worker_name]
-    ind = len(workers) + 1
-    for s_ind in range(len(workers) + 1):
-        if s_ind not in workers:
-            ind = s_ind
-    hub.proc.init.mk_proc(ind, workers, ret_ref, sock_dir)
-    # Make sure the process is up with a live socket
-    while True:
-        if os.path.exists(workers[ind]['path']):
-            break
-        await asyncio.sleep(0.01)
-    # Add all of the subs that have been added to processes in this pool
-    for sub in hub.proc.WorkersTrack[worker_name]['subs']:
-        payload = {'fun': 'sub', 'args': sub['args'], 'kwargs': sub['kwargs']}
-        async for chunk in hub.proc.run.send(workers[ind], payload):
-            pass
+    ind = min(s_ind for s_ind in range(len(workers) + 1) if s_ind not in workers)
+    await hub.proc.init.spawn(worker_name, ind)
+    # The worker is only registered once spawn runs, the cycle is rebuilt
+    # after it so that round robin picks up the new worker
+    hub.proc.WorkersIter[worker_name] = itertools.cycle(sorted(workers))
     return ind
 
 
-async def pub(hub, worker_name, func_ref, *args, **kwargs):
+async def pub(hub, worker_name, func_ref, *args, _timeout=None, _concurrency=None, **kwargs):
     '''
     Execute the given function reference on ALL the workers in the given
     worker pool and return the return data from each.
@@ -59,44 +46,208 @@ async def pub(hub, worker_name, func_ref, *args, **kwargs):
     Pass in the arguments for the function, keep in mind that the sub needs
     to be loaded into the workers for a function to be available via
     hub.proc.run.add_sub
+
+    :param _timeout: The number of seconds to wait for each worker
+    :param _concurrency: The maximum number of workers to send to at the
+        same time, defaults to all of them
     '''
-    workers = hub.proc.Workers[worker_name]
-    ret = {}
-    for ind in workers:
-        payload = {'fun': 'run', 'ref': func_ref, 'args': args, 'kwargs': kwargs}
-        # TODO: Make these futures to the run at the same time
-        async for chunk in hub.proc.run.send(workers[ind], payload):
-            ret[ind] = chunk
-    return ret
+    payload = {'fun': 'run', 'ref': func_ref, 'args': args, 'kwargs': kwargs}
+    return await hub.proc.run.fan_out(worker_name, payload, _timeout, _concurrency)
 
 
-async def set_attr(hub, worker_name, ref, value):
+async def set_attr(hub, worker_name, ref, value, _timeout=None, _concurrency=None):
     '''
     Set the given attribute to the given location on the hub of all
     worker procs
     '''
+    payload = {'fun': 'setattr', 'ref': ref, 'value': value}
+    return await hub.proc.run.fan_out(worker_name, payload, _timeout, _concurrency)
+
+
+async def fan_out(hub, worker_name, payload, timeout=None, concurrency=None):
+    '''
+    Send the payload to all of the workers in the named pool at the same
+    time and return a dict of the worker index to the return. Workers that
+    fail or time out do not fail the whole call, their return is a dict with
+    status set to False and the exception string, like errors raised inside
+    of the worker
+    '''
     workers = hub.proc.Workers[worker_name]
-    ret = {}
-    for ind in workers:
-        payload = {'fun': 'setattr', 'ref': ref, 'value': value}
-        # TODO: Make these futures to the run at the same time
-        async for chunk in hub.proc.run.send(workers[ind], payload):
-            ret[ind] = chunk
-    return ret
+    sem = asyncio.Semaphore(concurrency) if concurrency else None
+
+    async def _send(ind):
+        ret = None
+        deadline = hub.proc.run.deadline(worker_name, timeout)
+        sent = dict(payload, deadline=deadline) if deadline else payload
+        async for chunk in hub.proc.run.send(workers[ind], sent):
+            ret = chunk
+        return ret
+
+    async def _bounded(ind):
+        try:
+            if sem is None:
+                return await _send(ind)
+            async with sem:
+                return await _send(ind)
+        except asyncio.TimeoutError:
+            return {'status': False, 'exc': 'Timed out'}
+        except (OSError, asyncio.IncompleteReadError) as exc:
+            return {'status': False, 'exc': repr(exc)}
+
+    inds = list(workers)
+    rets = await asyncio.gather(*[_bounded(ind) for ind in inds])
+    return dict(zip(inds, rets))
+
+
+async def map(hub, worker_name, func_ref, iterable, chunksize=1, window=None, timeout=None):
+    '''
+    Execute the given function reference once for each item in the iterable
+    on the workers in the given worker pool and return the list of returns
+    in order. The items are sent to the workers in chunks of chunksize, see
+    hub.proc.run.imap
+    '''
+    rets = []
+    async for ret in hub.proc.run.imap(
+            worker_name, func_ref, iterable, chunksize, window=window, timeout=timeout):
+        rets.append(ret)
+    return rets
+
+
+async def imap(
+        hub,
+        worker_name,
+        func_ref,
+        iterable,
+        chunksize=1,
+        ordered=True,
+        window=None,
+        timeout=None):
+    '''
+    Execute the given function reference once for each item in the iterable,
+    or async iterable, on the workers in the given worker pool and yield the
+    returns.
+
+    The items are sent to the workers in chunks of chunksize so that many
+    small calls share a round trip. The iterable is only read as chunks are
+    sent, and no more than window chunks are in flight or waiting to be
+    yielded at once.
+
+    :param chunksize: The number of items to send to a worker in one call
+    :param ordered: Yield the returns in the order of the items, if False
+        the returns of each chunk are yielded as soon as it is done
+    :param window: The maximum number of chunks in flight, defaults to
+        twice the number of workers in the pool
+    :param timeout: The number of seconds each chunk can take once it is
+        sent, defaults to the timeout of the pool
+    '''
+    if window is None:
+        window = 2 * len(hub.proc.Workers[worker_name])
+    chunks = _chunks(iterable, chunksize)
+    pending = {}
+    seq = 0
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < window:
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                pending[seq] = asyncio.ensure_future(
+                    hub.proc.run.map_chunk(worker_name, func_ref, chunk, timeout))
+                seq += 1
+            if not pending:
+                return
+            if ordered:
+                done = [pending.pop(min(pending))]
+            else:
+                done, _ = await asyncio.wait(
+                    pending.values(), return_when=asyncio.FIRST_COMPLETED)
+                for key in [key for key, task in pending.items() if task in done]:
+                    pending.pop(key)
+            for task in done:
+                for ret in await task:
+                    yield ret
+    finally:
+        for task in pending.values():
+            task.cancel()
+        await chunks.aclose()
+
+
+async def _chunks(iterable, size):
+    '''
+    Yield lists of up to size items from the iterable or async iterable
+    '''
+    chunk = []
+    if hasattr(iterable, '__aiter__'):
+        async for item in iterable:
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    else:
+        for item in iterable:
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
 
 
-async def ind_func(hub, worker_name, _ind, func_ref, *args, **kwargs):
+async def map_chunk(hub, worker_name, func_ref, items, timeout=None):
+    '''
+    Execute the function reference for each of the items on one worker in
+    the given worker pool and return the list of returns
+    '''
+    ind = hub.proc.run.pick(worker_name)
+    payload = {
+        'fun': 'map',
+        'ref': func_ref,
+        'items': items,
+        'deadline': hub.proc.run.deadline(worker_name, timeout)}
+    async for ret in hub.proc.run.send(hub.proc.Workers[worker_name][ind], payload):
+        if isinstance(ret, dict):
+            # The whole chunk failed
+            return [ret] * len(items)
+        return ret
+
+
+def deadline(hub, worker_name, timeout=None):
+    '''
+    Return the deadline for a call made now that can take timeout seconds,
+    or None if neither the call nor the pool has a timeout. The workers run
+    on the same host, so the monotonic clock is shared with them
+    '''
+    if timeout is None:
+        timeout = hub.proc.WorkersTrack[worker_name]['timeout']
+    if timeout is None:
+        return None
+    return time.monotonic() + timeout
+
+
+async def ind_func(hub, worker_name, _ind, func_ref, *args, _timeout=None, **kwargs):
     '''
     Execute the function on the indexed process within the named worker pool
+
+    :param _timeout: The number of seconds the call can take, defaults to
+        the timeout of the pool. The call is cancelled on the worker and
+        asyncio.TimeoutError is raised when it runs out
     '''
     workers = hub.proc.Workers[worker_name]
     worker = workers[_ind]
-    payload = {'fun': 'run', 'ref': func_ref, 'args': args, 'kwargs': kwargs}
+    payload = {
+        'fun': 'run',
+        'ref': func_ref,
+        'args': args,
+        'kwargs': kwargs,
+        'deadline': hub.proc.run.deadline(worker_name, _timeout)}
     async for ret in hub.proc.run.send(worker, payload):
         return ret
 
 
-async def func(hub, worker_name, func_ref, *args, **kwargs):
+async def func(hub, worker_name, func_ref, *args, _key=None, _timeout=None, **kwargs):
     '''
     Execute the given function reference on one worker in the given worker
     pool and return the return data.
@@ -104,75 +255,224 @@ async def func(hub, worker_name, func_ref, *args, **kwargs):
     Pass in the arguments for the function, keep in mind that the sub needs
     to be loaded into the workers for a function to be available via
     hub.proc.run.add_sub
+
+    :param _key: A key passed to the dispatch policy of the pool, with the
+        affinity policy all calls with the same key run on the same worker
+    :param _timeout: The number of seconds the call can take, see
+        hub.proc.run.ind_func
     '''
-    ind, coro = await hub.proc.run.track_func(worker_name, func_ref, *args, **kwargs)
+    ind, coro = await hub.proc.run.track_func(
+        worker_name, func_ref, *args, _key=_key, _timeout=_timeout, **kwargs)
     return await coro
 
 
-async def track_func(hub, worker_name, func_ref, *args, **kwargs):
+def pick(hub, worker_name, key=None):
+    '''
+    Return the index of the worker to run the next call on, as chosen by the
+    dispatch policy of the pool
+    '''
+    policy = getattr(hub.proc.dispatch, hub.proc.WorkersTrack[worker_name]['policy'])
+    workers = hub.proc.Workers[worker_name]
+    ind = policy(worker_name, key)
+    # Route around workers that are being respawned
+    for _ in range(len(workers)):
+        if hub.proc.run.alive(workers[ind]):
+            return ind
+        ind = policy(worker_name, key)
+    up = [ind for ind, worker in workers.items() if hub.proc.run.alive(worker)]
+    if up:
+        return min(up, key=lambda ind: workers[ind]['inflight'])
+    return ind
+
+
+def alive(hub, worker):
+    '''
+    Return True if the worker is up and taking calls. A worker only drops
+    the connection when it exits, so a lost connection is counted as dead
+    before the exit is seen
+    '''
+    if not worker['ready'].done() or 'returncode' in worker:
+        return False
+    fut = worker.get('conn')
+    if fut is None or not fut.done():
+        return True
+    return not fut.cancelled() and not fut.exception() and not fut.result()['closed']
+
+
+async def track_func(hub, worker_name, func_ref, *args, _key=None, _timeout=None, **kwargs):
     '''
     Run a function and return the index of the worker that the function was
     executed on and a coroutine to track
     '''
-    w_iter = hub.proc.WorkersIter[worker_name]
-    ind = next(w_iter)
-    coro = hub.proc.run.ind_func(worker_name, ind, func_ref, *args, **kwargs)
+    ind = hub.proc.run.pick(worker_name, _key)
+    coro = hub.proc.run.ind_func(worker_name, ind, func_ref, *args, _timeout=_timeout, **kwargs)
     return ind, coro
 
 
-async def gen(hub, worker_name, func_ref, *args, **kwargs):
+async def gen(hub, worker_name, func_ref, *args, _key=None, _timeout=None, **kwargs):
     '''
     Execute a generator function reference within one worker within the given
     worker pool.
 
     Like `func` the sub needs to be made available to all workers first
+
+    :param _timeout: The number of seconds the whole generator can take,
+        defaults to the timeout of the pool
     '''
-    ind, coro = await hub.proc.run.track_gen(worker_name, func_ref, *args, **kwargs)
-    async for chunk in coro:
-        yield chunk
+    ind, coro = await hub.proc.run.track_gen(
+        worker_name, func_ref, *args, _key=_key, _timeout=_timeout, **kwargs)
+    try:
+        async for chunk in coro:
+            yield chunk
+    finally:
+        await coro.aclose()
 
 
-async def track_gen(hub, worker_name, func_ref, *args, **kwargs):
+async def track_gen(hub, worker_name, func_ref, *args, _key=None, _timeout=None, **kwargs):
     '''
     Return an iterable coroutine and the index executed on
     '''
-    w_iter = hub.proc.WorkersIter[worker_name]
-    ind = next(w_iter)
-    coro = hub.proc.run.ind_gen(worker_name, ind, func_ref, *args, **kwargs)
+    ind = hub.proc.run.pick(worker_name, _key)
+    coro = hub.proc.run.ind_gen(worker_name, ind, func_ref, *args, _timeout=_timeout, **kwargs)
     return ind, coro
 
 
-async def ind_gen(hub, worker_name, _ind, func_ref, *args, **kwargs):
+async def ind_gen(hub, worker_name, _ind, func_ref, *args, _timeout=None, **kwargs):
     '''
     run the given iterator on the defined index
     '''
     workers = hub.proc.Workers[worker_name]
     worker = workers[_ind]
-    payload = {'fun': 'gen', 'ref': func_ref, 'args': args, 'kwargs': kwargs}
-    async for chunk in hub.proc.run.send(worker, payload):
-        yield chunk
+    payload = {
+        'fun': 'gen',
+        'ref': func_ref,
+        'args': args,
+        'kwargs': kwargs,
+        'credit': hub.proc.GEN_CREDIT,
+        'deadline': hub.proc.run.deadline(worker_name, _timeout)}
+    agen = hub.proc.run.send(worker, payload)
+    try:
+        async for chunk in agen:
+            yield chunk
+    finally:
+        await agen.aclose()
 
 
 async def send(hub, worker, payload):
     '''
     Send the given payload to the given worker, yield iterations based on the
     returns from the remote.
+
+    The payload is sent over the long lived connection to the worker, tagged
+    with a request id so that many calls can be in flight at the same time.
+    If the payload carries credit the worker sends that many items ahead of
+    the consumer, credit is granted back as the items are consumed. If this
+    is closed before the worker is done the request is cancelled on the
+    worker. If the payload carries a deadline asyncio.TimeoutError is raised
+    when it passes.
     '''
-    mp = msgpack.dumps(payload, use_bin_type=True)
-    mp += hub.proc.DELIM
-    reader, writer = await asyncio.open_unix_connection(path=worker['path'])
-    writer.write(mp)
-    await writer.drain()
-    final_ret = True
-    while True:
-        ret = await reader.readuntil(hub.proc.DELIM)
-        p_ret = ret[:-len(hub.proc.DELIM)]
-        i_flag = p_ret[-1:]
-        ret = msgpack.loads(p_ret[:-1], raw=False)
-        if i_flag == hub.proc.D_FLAG:
-            # break for the end of the sequence
-            break
-        yield ret
-        final_ret = False
-    if final_ret:
+    await worker['ready']
+    conn = await hub.proc.run.conn(worker)
+    worker['inflight'] += 1
+    # Request ids are 32 bit on the wire
+    rid = next(conn['rids']) & 0xffffffff
+    que = asyncio.Queue()
+    conn['pending'][rid] = que
+    names = set()
+    credit = payload.get('credit')
+    deadline = payload.get('deadline')
+    consumed = 0
+    done = False
+    try:
+        await hub.proc.wire.send(
+            conn['writer'], conn['lock'], rid, hub.proc.R_FLAG, payload, worker.get('shm'), names)
+        final_ret = True
+        while True:
+            if deadline is None:
+                i_flag, ret = await que.get()
+            else:
+                i_flag, ret = await asyncio.wait_for(que.get(), max(0, deadline - time.monotonic()))
+            if i_flag is None:
+                # The connection to the worker was lost
+                done = True
+                raise ret
+            if i_flag == hub.proc.D_FLAG:
+                # break for the end of the sequence
+                done = True
+                break
+            yield ret
+            final_ret = False
+            if credit:
+                consumed += 1
+                if consumed * 2 >= credit:
+                    await hub.proc.wire.send(conn['writer'], conn['lock'], rid, hub.proc.K_FLAG, consumed)
+                    consumed = 0
+    finally:
+        if not done and not conn['closed']:
+            try:
+                await hub.proc.wire.send(conn['writer'], conn['lock'], rid, hub.proc.C_FLAG, None)
+            except OSError:
+                pass
+        conn['pending'].pop(rid, None)
+        worker['inflight'] -= 1
+        if names:
+            hub.proc.shm.release(names)
+    if final_ret or ret != '':
+        # The return of a call, or the error a generator failed with
         yield ret
+
+
+async def conn(hub, worker):
+    '''
+    Return the connection to the given worker, opening it if there is not
+    a live one
+    '''
+    fut = worker.get('conn')
+    if fut is not None and fut.done():
+        if fut.cancelled() or fut.exception() or fut.result()['closed']:
+            fut = None
+    if fut is None:
+        fut = asyncio.ensure_future(hub.proc.run.connect(worker))
+        worker['conn'] = fut
+    return await asyncio.shield(fut)
+
+
+async def connect(hub, worker):
+    '''
+    Open a connection to the worker and start reading the returns from it
+    '''
+    reader, writer = await asyncio.open_unix_connection(path=worker['path'])
+    conn = {
+        'reader': reader,
+        'writer': writer,
+        'lock': asyncio.Lock(),
+        'rids': itertools.count(),
+        'pending': {},
+        'closed': False,
+        'shm': worker.get('shm'),
+        }
+    conn['task'] = asyncio.ensure_future(hub.proc.run.recv(conn))
+    return conn
+
+
+async def recv(hub, conn):
+    '''
+    Read the returns from a worker connection and route them to the
+    calls waiting on them
+    '''
+    try:
+        while True:
+            try:
+                rid, i_flag, ret = await hub.proc.wire.recv(conn['reader'], conn['shm'])
+            except pop.exc.ProcFrameError as exc:
+                # Only the call the frame belongs to fails
+                rid, i_flag, ret = exc.rid, hub.proc.D_FLAG, {'status': False, 'exc': str(exc)}
+            que = conn['pending'].get(rid)
+            if que is not None:
+                que.put_nowait((i_flag, ret))
+    except (asyncio.IncompleteReadError, OSError) as exc:
+        error = ConnectionResetError(f'Lost the connection to the worker: {exc!r}')
+    conn['closed'] = True
+    conn['writer'].close()
+    for que in conn['pending'].values():
+        que.put_nowait((None, error))
@@ -0,0 +1,124 @@
+'''
+Shared memory transport for large payloads. Buffers over the threshold of
+the pool are written to a shared memory segment and only the name of the
+segment is sent in the frame.
+
+The receiver maps the segment and unlinks its name straight away, the buffer
+is handed over as a memoryview of the mapping so it is not copied again. The
+memory is freed by the kernel once the sender has closed its mapping and
+every view of the receiver is released. Segments that were never received
+are unlinked by the sender when the request or connection ends.
+
+Segment names are only decoded on the connections of pools started with shm,
+the msgpack extension type code used for them is hub.proc.shm.EXT. Set it
+before the pool is started if the code is already used by the payloads.
+'''
+# Import python libs
+import os
+import re
+import mmap
+import tempfile
+
+# Import third party libs
+import msgpack
+
+PREFIX = 'pop-proc-'
+# The names made by put, anything else is refused by get
+NAME_RE = re.compile(re.escape(PREFIX) + '[0-9a-f]{16}')
+
+
+def __init__(hub):
+    '''
+    Shared memory segments are files in a memory backed directory
+    '''
+    if os.path.isdir('/dev/shm'):
+        hub.proc.shm.DIR = '/dev/shm'
+    else:
+        hub.proc.shm.DIR = tempfile.gettempdir()
+    # The msgpack extension type code of a shared memory segment name
+    hub.proc.shm.EXT = 42
+
+
+def export(hub, data, threshold, names):
+    '''
+    Return the data with every bytes like object of at least threshold
+    bytes moved to shared memory, the names of the new segments are added
+    to the names set
+    '''
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        if threshold and memoryview(data).nbytes >= threshold:
+            return hub.proc.shm.put(data, names)
+        return data
+    if isinstance(data, dict):
+        return {key: hub.proc.shm.export(val, threshold, names) for key, val in data.items()}
+    if isinstance(data, msgpack.ExtType):
+        # An extension type is a tuple, it is sent as it is
+        return data
+    if isinstance(data, (list, tuple)):
+        return [hub.proc.shm.export(val, threshold, names) for val in data]
+    return data
+
+
+def put(hub, data, names):
+    '''
+    Copy the buffer into a new shared memory segment and return the
+    extension type sent in its place
+    '''
+    data = memoryview(data).cast('B')
+    name = PREFIX + os.urandom(8).hex()
+    path = os.path.join(hub.proc.shm.DIR, name)
+    fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+    try:
+        os.ftruncate(fd, data.nbytes)
+        with mmap.mmap(fd, data.nbytes) as mm:
+            mm[:] = data
+    finally:
+        os.close(fd)
+    names.add(name)
+    return msgpack.ExtType(hub.proc.shm.EXT, name.encode())
+
+
+def get(hub, name):
+    '''
+    Map the named shared memory segment, unlink it and return a memoryview
+    of the mapping. Only the names made by put are accepted
+    '''
+    if not NAME_RE.fullmatch(name):
+        raise ValueError(f'Invalid shared memory segment name {name!r}')
+    path = os.path.join(hub.proc.shm.DIR, name)
+    fd = os.open(path, os.O_RDWR)
+    try:
+        mm = mmap.mmap(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+        os.unlink(path)
+    return memoryview(mm)
+
+
+def ext_hook(hub, code, data):
+    '''
+    Resolve the msgpack extension types when a frame is decoded
+    '''
+    if code == hub.proc.shm.EXT:
+        return hub.proc.shm.get(data.decode())
+    return msgpack.ExtType(code, data)
+
+
+def release(hub, names):
+    '''
+    Unlink the named segments that were never received
+    '''
+    for name in names:
+        try:
+            os.unlink(os.path.join(hub.proc.shm.DIR, name))
+        except FileNotFoundError:
+            pass
+    names.clear()
+
+
+def prune(hub, names):
+    '''
+    Forget the named segments that have been received
+    '''
+    for name in [name for name in names if not os.path.exists(os.path.join(hub.proc.shm.DIR, name))]:
+        names.discard(name)
@@ -0,0 +1,55 @@
+'''
+The wire format used between the proc workers and the process that created
+them. Every message is a frame made of a fixed size header followed by a
+msgpack body. The header holds the length of the body, a flag byte and the
+id of the request the frame belongs to.
+'''
+# Import third party libs
+import msgpack
+
+# Import pop libs
+import pop.exc
+
+
+def pack(hub, rid, flag, data, shm=None, names=None):
+    '''
+    Return the header and body of a frame
+
+    :param shm: Move buffers of at least this many bytes to shared memory,
+        the names of the segments are added to the names set
+    '''
+    if shm:
+        data = hub.proc.shm.export(data, shm, names)
+    body = msgpack.dumps(data, use_bin_type=True)
+    return hub.proc.HEADER.pack(len(body), flag, rid), body
+
+
+async def send(hub, writer, lock, rid, flag, data, shm=None, names=None):
+    '''
+    Write a frame to the stream, the lock keeps frames written by concurrent
+    tasks from interleaving
+    '''
+    frame = hub.proc.wire.pack(rid, flag, data, shm, names)
+    async with lock:
+        writer.writelines(frame)
+        await writer.drain()
+
+
+async def recv(hub, reader, shm=None):
+    '''
+    Read the next frame from the stream and return the request id, flag and
+    decoded body. pop.exc.ProcFrameError is raised for a body that can not
+    be decoded, such as one naming a shared memory segment that is gone
+
+    :param shm: Resolve the shared memory segments named in the body, only
+        set for the connections of pools started with shm
+    '''
+    header = await reader.readexactly(hub.proc.HEADER.size)
+    length, flag, rid = hub.proc.HEADER.unpack(header)
+    body = await reader.readexactly(length)
+    kwargs = {'ext_hook': hub.proc.shm.ext_hook} if shm else {}
+    try:
+        data = msgpack.loads(body, raw=False, **kwargs)
+    except Exception as exc:  # pylint: disable=broad-except
+        raise pop.exc.ProcFrameError(rid, flag, f'Failed to decode the frame: {exc!r}') from exc
+    return rid, flag, data
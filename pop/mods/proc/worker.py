@@ -3,34 +3,71 @@ This module is used to manage the process started up by the pool. Work in this
 module is used to manage the worker process itself and not other routines on
 the hub this process was derived from
 
-This is an exec, not a fork! This is a fresh memory space!
+Workers are either executed as a fresh interpreter or forked from the
+template hub of a fork server, see hub.proc.fork
 '''
 # Import python libs
 import os
+import sys
+import json
+import time
 import types
 import asyncio
+
 # Import third party libs
 import msgpack
+
+# Import pop libs
+import pop.exc
 # TODO: The workers should detect if their controlling process dies and terminate by themselves
 # The controlling process will kill them when it exists, but if it exists hard then the workers
 # Should be able to also clean themselves up
 
 
-def start(hub, sock_dir, ind, ref, ret_ref):
+def start(hub, sock_dir, ind, ref, ret_ref, ready_fd=None, shm=None, preload=None, warmup=None, shm_ext=None):
     '''
-    This function is called by the startup script to create a worker process
+    This function is called by the startup script, or by the fork server, to
+    create a worker process
 
-    :NOTE: This is a new process started from the shell, it does not have any
-    of the process namespace from the creating process.
-    This is an EXEC, NOT a FORK!
+    :NOTE: This process does not have any of the process namespace from the
+    creating process, only what was loaded onto the hub it was started with
+
+    :param ready_fd: The pipe to report readiness over once the socket is
+        listening
+    :param shm: Send returned buffers of at least this many bytes through
+        shared memory
+    :param preload: The subs to load before the worker is ready
+    :param warmup: The functions to call before the worker is ready
+    :param shm_ext: The msgpack extension type code of shared memory segments
     '''
+    hub.proc.READY_FD = ready_fd
+    hub.proc.SHM = shm
+    if shm_ext is not None:
+        hub.proc.shm.EXT = shm_ext
+    # The names of the segments sent on each connection, by its writer
+    hub.proc.SHM_NAMES = {}
     hub.proc.SOCK_DIR = sock_dir
     hub.proc.REF = ref
     hub.proc.SOCK_PATH = os.path.join(sock_dir, ref)
     hub.proc.RET_REF = ret_ref
     hub.proc.RET_SOCK_PATH = os.path.join(sock_dir, ret_ref)
     hub.proc.IND = ind
-    hub.pop.loop.start(hub.proc.worker.hold(), hub.proc.worker.server())
+    hub.proc.worker.preload(preload)
+    hub.pop.loop.start(hub.proc.worker.hold(), hub.proc.worker.server(warmup))
+
+
+def start_stdin(hub):
+    '''
+    Read the arguments of start from stdin and start the worker, this is
+    how an executed worker is started
+    '''
+    with open(sys.stdin.fileno(), 'rb', closefd=False) as stdin:
+        cmd = msgpack.loads(stdin.read(), raw=False)
+    # The creating process only writes the arguments
+    null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null, sys.stdin.fileno())
+    os.close(null)
+    hub.proc.worker.start(**cmd)
 
 
 async def hold(hub):
@@ -41,22 +78,141 @@ async def hold(hub):
         await asyncio.sleep(60)
 
 
-async def server(hub):
+def preload(hub, subs):
     '''
-    Start the unix socket server to receive commands
+    Add the given subs and load all of their modules now rather than on
+    first use
+    '''
+    for sub in subs or []:
+        before = dict(hub._subs)
+        hub.pop.sub.add(*sub['args'], **sub['kwargs'])
+        for name, new in hub._subs.items():
+            if before.get(name) is not new:
+                hub.pop.sub.load_all(name)
+
+
+async def warmup(hub, calls):
+    '''
+    Call the given functions, an exception stops the worker from starting
+    '''
+    for call in calls or []:
+        ret = hub.pop.ref.last(call['ref'])(*call['args'], **call['kwargs'])
+        if asyncio.iscoroutine(ret):
+            await ret
+
+
+async def server(hub, warmup=None):
     '''
+    Start the unix socket server to receive commands once the warmup calls
+    are done
+    '''
+    await hub.proc.worker.warmup(warmup)
     await asyncio.start_unix_server(
             hub.proc.worker.work,
             path=hub.proc.SOCK_PATH)
+    hub.proc.worker.report_ready()
+
+
+def report_ready(hub):
+    '''
+    Tell the creating process that this worker is accepting connections.
+    The pipe is held open for the life of the worker so that the creating
+    process sees it close when the worker exits
+    '''
+    fd = hub.proc.READY_FD
+    if fd is None:
+        return
+    msg = {'ready': True, 'ind': hub.proc.IND, 'pid': os.getpid()}
+    os.write(fd, json.dumps(msg).encode() + b'\n')
 
 
 async def work(hub, reader, writer):
     '''
-    Process the incoming work
+    Process the incoming work, the connection is kept open and every
+    request is run in its own task so that many can be in flight at once.
+    The caller can cancel a request and grant a generator more items. A
+    request that can not be decoded, because the caller already released its
+    shared memory, is answered with the error
+    '''
+    lock = asyncio.Lock()
+    reqs = {}
+    hub.proc.SHM_NAMES[writer] = set()
+    try:
+        while True:
+            try:
+                rid, flag, payload = await hub.proc.wire.recv(reader, hub.proc.SHM)
+            except pop.exc.ProcFrameError as exc:
+                if exc.flag == hub.proc.R_FLAG:
+                    ret = {'status': False, 'exc': str(exc)}
+                    await hub.proc.worker.send(exc.rid, ret, hub.proc.D_FLAG, writer, lock)
+                continue
+            if flag == hub.proc.C_FLAG:
+                if rid in reqs:
+                    reqs[rid]['task'].cancel()
+                continue
+            if flag == hub.proc.K_FLAG:
+                if rid in reqs and reqs[rid]['credit']:
+                    for _ in range(payload):
+                        reqs[rid]['credit'].release()
+                continue
+            credit = None
+            if isinstance(payload, dict) and payload.get('credit'):
+                credit = asyncio.Semaphore(payload['credit'])
+            task = asyncio.ensure_future(hub.proc.worker.handle(rid, payload, writer, lock, credit))
+            reqs[rid] = {'task': task, 'credit': credit}
+            task.add_done_callback(lambda _, rid=rid: reqs.pop(rid, None))
+    except (asyncio.IncompleteReadError, OSError):
+        # The caller closed the connection
+        pass
+    for req in list(reqs.values()):
+        req['task'].cancel()
+    writer.close()
+    # Only the segments sent on this connection
+    hub.proc.shm.release(hub.proc.SHM_NAMES.pop(writer))
+
+
+async def handle(hub, rid, payload, writer, lock, credit=None):
+    '''
+    Run a single request and send the return. A request with a deadline is
+    dropped if the deadline has passed before it starts and cancelled if it
+    is still running when the deadline passes. Every request that is not
+    cancelled by the caller is answered with a D frame, a request that fails,
+    or whose return can not be sent, is answered with the error
+
+    :param credit: The semaphore a generator acquires for every item sent
+    '''
+    deadline = payload.get('deadline') if isinstance(payload, dict) else None
+    try:
+        if deadline is None:
+            ret = await hub.proc.worker.dispatch(rid, payload, writer, lock, credit)
+        elif deadline <= time.monotonic():
+            ret = {'status': False, 'exc': 'The deadline passed before the call started'}
+        else:
+            try:
+                ret = await asyncio.wait_for(
+                    hub.proc.worker.dispatch(rid, payload, writer, lock, credit),
+                    deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                ret = {'status': False, 'exc': 'The deadline passed before the call finished'}
+    except Exception as exc:  # pylint: disable=broad-except
+        ret = {'status': False, 'exc': str(exc)}
+    try:
+        await hub.proc.worker.send(rid, ret, hub.proc.D_FLAG, writer, lock)
+    except OSError:
+        # The caller is gone
+        return
+    except Exception as exc:  # pylint: disable=broad-except
+        ret = {'status': False, 'exc': f'Failed to send the return: {exc}'}
+        try:
+            await hub.proc.worker.send(rid, ret, hub.proc.D_FLAG, writer, lock)
+        except OSError:
+            return
+
+
+async def dispatch(hub, rid, payload, writer, lock, credit=None):
+    '''
+    Run a single request and return the return
     '''
-    inbound = await reader.readuntil(hub.proc.DELIM)
-    inbound = inbound[:-len(hub.proc.DELIM)]
-    payload = msgpack.loads(inbound, encoding='utf8')
     ret = b''
     if 'fun' not in payload:
         ret = {'err': 'Invalid format'}
@@ -73,16 +229,31 @@ async def work(hub, reader, writer):
             ret = await hub.proc.worker.run(payload)
         except Exception as exc:
             ret = {'status': False, 'exc': str(exc)}
+    elif payload['fun'] == 'map':
+        try:
+            ret = await hub.proc.worker.map(payload)
+        except Exception as exc:
+            ret = {'status': False, 'exc': str(exc)}
     elif payload['fun'] == 'gen':
-        ret = await hub.proc.worker.gen(payload, reader, writer)
+        ret = await hub.proc.worker.gen(rid, payload, writer, lock, credit)
     elif payload['fun'] == 'setattr':
         ret = await hub.proc.worker.set_attr(payload)
-    ret = msgpack.dumps(ret, use_bin_type=True)
-    ret += hub.proc.D_FLAG
-    ret += hub.proc.DELIM
-    writer.write(ret)
-    await writer.drain()
-    writer.close()
+    return ret
+
+
+async def send(hub, rid, ret, flag, writer, lock):
+    '''
+    Send a return for the given request id back to the caller, the shared
+    memory segments are tracked with the connection they are sent on
+    '''
+    names = hub.proc.SHM_NAMES.get(writer)
+    if names is None:
+        # The connection has been torn down, nothing would release them
+        await hub.proc.wire.send(writer, lock, rid, flag, ret)
+        return
+    await hub.proc.wire.send(writer, lock, rid, flag, ret, hub.proc.SHM, names)
+    if len(names) > 64:
+        hub.proc.shm.prune(names)
 
 
 def add_sub(hub, payload):
@@ -92,29 +263,37 @@ def add_sub(hub, payload):
     hub.pop.sub.add(*payload['args'], **payload['kwargs'])
 
 
-async def gen(hub, payload, reader, writer):
+async def send_item(hub, rid, chunk, writer, lock, credit=None):
+    '''
+    Send an item of a generator, waiting for the caller to grant credit for
+    it first
+    '''
+    if credit is not None:
+        await credit.acquire()
+    await hub.proc.worker.send(rid, chunk, hub.proc.I_FLAG, writer, lock)
+
+
+async def gen(hub, rid, payload, writer, lock, credit=None):
     '''
     Run a generator and yield back the returns. Supports a generator and an
-    async generator
+    async generator. The generator is closed if the request is cancelled
     '''
     ref = payload.get('ref')
     args = payload.get('args', [])
     kwargs = payload.get('kwargs', {})
     ret = hub.pop.ref.last(ref)(*args, **kwargs)
     if isinstance(ret, types.AsyncGeneratorType):
-        async for chunk in ret:
-            rchunk = msgpack.dumps(chunk, use_bin_type=True)
-            rchunk += hub.proc.I_FLAG
-            rchunk += hub.proc.DELIM
-            writer.write(rchunk)
-            await writer.drain()
+        try:
+            async for chunk in ret:
+                await hub.proc.worker.send_item(rid, chunk, writer, lock, credit)
+        finally:
+            await ret.aclose()
     elif isinstance(ret, types.GeneratorType):
-        for chunk in ret:
-            rchunk = msgpack.dumps(chunk, use_bin_type=True)
-            rchunk += hub.proc.I_FLAG
-            rchunk += hub.proc.DELIM
-            writer.write(rchunk)
-            await writer.drain()
+        try:
+            for chunk in ret:
+                await hub.proc.worker.send_item(rid, chunk, writer, lock, credit)
+        finally:
+            ret.close()
     elif asyncio.iscoroutine(ret):
         return await ret
     else:
@@ -135,6 +314,32 @@ async def run(hub, payload):
     return ret
 
 
+async def map(hub, payload):
+    '''
+    Execute the function in the payload once for each of the items and
+    return the list of returns, the coroutines are run concurrently. A
+    failing item is returned in the same form as a failing run
+    '''
+    func = hub.pop.ref.last(payload.get('ref'))
+    rets = []
+    coros = {}
+    for ind, item in enumerate(payload.get('items', [])):
+        try:
+            ret = func(item)
+        except Exception as exc:
+            ret = {'status': False, 'exc': str(exc)}
+        if asyncio.iscoroutine(ret):
+            coros[ind] = ret
+        rets.append(ret)
+    if coros:
+        done = await asyncio.gather(*coros.values(), return_exceptions=True)
+        for ind, ret in zip(coros, done):
+            if isinstance(ret, Exception):
+                ret = {'status': False, 'exc': str(ret)}
+            rets[ind] = ret
+    return rets
+
+
 async def set_attr(hub, payload):
     '''
     Set the named attribute to the hub
@@ -150,12 +355,8 @@ async def ret(hub, payload):
     with the index of the process that returned it
     '''
     payload = {'ind': hub.proc.IND, 'payload': payload}
-    mp = msgpack.dumps(payload, use_bin_type=True)
-    mp += hub.proc.DELIM
     reader, writer = await asyncio.open_unix_connection(path=hub.proc.RET_SOCK_PATH)
-    writer.write(mp)
-    await writer.drain()
-    ret = await reader.readuntil(hub.proc.DELIM)
-    ret = ret[:-len(hub.proc.DELIM)]
+    await hub.proc.wire.send(writer, asyncio.Lock(), 0, hub.proc.R_FLAG, payload)
+    _, _, ret = await hub.proc.wire.recv(reader)
     writer.close()
-    return msgpack.loads(ret, encoding='utf8')
+    return ret
@@ -0,0 +1,168 @@
+'''
+Record where the time goes in the functions on the hub. The profiler is
+installed on pop.contract and every call of a Contracted function is then
+passed through it, see hub.pop.profile for the interface.
+'''
+# Import python libs
+import json
+import asyncio
+import inspect
+import contextvars
+from time import perf_counter
+
+# The frame of the hub function that is running in the current context
+_CURRENT = contextvars.ContextVar('pop_profile_frame', default=None)
+
+
+class _Frame:  # pylint: disable=too-few-public-methods
+    '''
+    A running call of a hub function
+    '''
+    __slots__ = ('key', 'path', 'child')
+
+    def __init__(self, key, parent):
+        self.key = key
+        self.path = key if parent is None else f'{parent.path};{key}'
+        self.child = 0.0
+
+
+class Profiler:
+    '''
+    Collect the call counts, the cumulative and self wall time, and the
+    exception counts of the hub functions by reference. Coroutines and async
+    generators are timed while they run, including the time they spend
+    awaiting, and the calls they make are counted as their children.
+    Cancelled calls are timed but not counted as exceptions. The calls of
+    the modules with a ref in ignore are run without being recorded.
+    '''
+    def __init__(self, ignore=()):
+        self.ignore = frozenset(ignore)
+        self.stats = {}
+        self.stacks = {}
+
+    def clear(self):
+        '''
+        Forget everything that was recorded
+        '''
+        self.stats.clear()
+        self.stacks.clear()
+
+    def call(self, contracted, args, kwargs):
+        '''
+        Run the call of the Contracted function and record it
+        '''
+        if contracted.ref in self.ignore:
+            return contracted._call(*args, **kwargs)  # pylint: disable=protected-access
+        parent = _CURRENT.get()
+        frame = _Frame(f'{contracted.ref}.{contracted.name}', parent)
+        token = _CURRENT.set(frame)
+        start = perf_counter()
+        try:
+            ret = contracted._call(*args, **kwargs)  # pylint: disable=protected-access
+        except BaseException as exc:
+            self._record(frame, parent, perf_counter() - start, isinstance(exc, Exception))
+            raise
+        finally:
+            _CURRENT.reset(token)
+        if asyncio.iscoroutine(ret):
+            return self._coro(frame, parent, ret)
+        if inspect.isasyncgen(ret):
+            return self._agen(frame, parent, ret)
+        self._record(frame, parent, perf_counter() - start, False)
+        return ret
+
+    async def _coro(self, frame, parent, coro):
+        '''
+        Await the coroutine and record the time until it is done
+        '''
+        token = _CURRENT.set(frame)
+        start = perf_counter()
+        try:
+            ret = await coro
+        except BaseException as exc:
+            self._record(frame, parent, perf_counter() - start, isinstance(exc, Exception))
+            raise
+        finally:
+            _CURRENT.reset(token)
+        self._record(frame, parent, perf_counter() - start, False)
+        return ret
+
+    async def _agen(self, frame, parent, agen):
+        '''
+        Iterate the async generator and record the time spent getting its
+        values, the time the consumer holds it is not counted
+        '''
+        elapsed = 0.0
+        failed = False
+        try:
+            while True:
+                token = _CURRENT.set(frame)
+                start = perf_counter()
+                try:
+                    item = await agen.__anext__()
+                except StopAsyncIteration:
+                    break
+                except Exception:
+                    failed = True
+                    raise
+                finally:
+                    elapsed += perf_counter() - start
+                    _CURRENT.reset(token)
+                yield item
+        finally:
+            await agen.aclose()
+            self._record(frame, parent, elapsed, failed)
+
+    def _record(self, frame, parent, elapsed, failed):
+        '''
+        Add the finished call to the stats
+        '''
+        stat = self.stats.get(frame.key)
+        if stat is None:
+            stat = self.stats[frame.key] = [0, 0.0, 0.0, 0]
+        own = max(elapsed - frame.child, 0.0)
+        stat[0] += 1
+        stat[1] += elapsed
+        stat[2] += own
+        if failed:
+            stat[3] += 1
+        self.stacks[frame.path] = self.stacks.get(frame.path, 0.0) + own
+        if parent is not None:
+            parent.child += elapsed
+
+    def data(self):
+        '''
+        Return the stats as a dict of the function references to their
+        calls, cumtime, selftime and exceptions
+        '''
+        return {
+            key: {'calls': calls, 'cumtime': cum, 'selftime': own, 'exceptions': exc}
+            for key, (calls, cum, own, exc) in self.stats.items()}
+
+    def table(self, sort='cumtime', limit=None):
+        '''
+        Return the stats as a text table, sorted by the named column
+        '''
+        data = sorted(self.data().items(), key=lambda item: item[1][sort], reverse=True)
+        if limit:
+            data = data[:limit]
+        lines = [f'{"calls":>9} {"cumtime":>10} {"selftime":>10} {"percall":>10} {"exc":>6}  function']
+        for key, stat in data:
+            lines.append(
+                f'{stat["calls"]:>9} {stat["cumtime"]:>10.6f} {stat["selftime"]:>10.6f} '
+                f'{stat["cumtime"] / stat["calls"]:>10.6f} {stat["exceptions"]:>6}  {key}')
+        return '\n'.join(lines)
+
+    def json(self):
+        '''
+        Return the stats as a JSON document
+        '''
+        return json.dumps(self.data(), indent=2, sort_keys=True)
+
+    def collapsed(self):
+        '''
+        Return the self time in microseconds of each call stack in the
+        collapsed stack format read by flamegraph tools
+        '''
+        return '\n'.join(
+            f'{path} {round(own * 1e6)}' for path, own in sorted(self.stacks.items()))
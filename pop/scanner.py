@@ -4,18 +4,103 @@ Used to scan the given directories for loadable files
 '''
 # Import python libs
 import os
+import ast
+import time
+import atexit
+import weakref
 import importlib
 import collections
 
+# Import pop libs
+import pop.cache
+
 PY_END = ('.py', '.pyc', '.pyo')
 PYEXT_END = tuple(importlib.machinery.EXTENSION_SUFFIXES)
 CYTHON_END = ('.pyx',)
 SKIP_DIRNAMES = ('__pycache__',)
+# The coarsest mtime granularity of the filesystems we expect to run on, a
+# listing taken within this long of the last change of its directory could
+# have missed a change that did not move the mtime
+MTIME_TICK_NS = 2 * 10**9
+# The caches holding listings that have not been written out yet, weak so a
+# dropped hub does not keep its cache alive until exit
+_DIRTY = weakref.WeakSet()
+
+
+class ScanCache:
+    '''
+    A persistent cache of directory listings. Each directory is keyed by its
+    path and mtime_ns, so a directory only needs a single stat call to be
+    reused from the cache instead of being listed again. A listing is only
+    trusted if it was taken at least a tick after the last change of the
+    directory.
+
+    Changes are written out by dump, which is called once the subs are loaded
+    and, for the caches that are still dirty, when the process exits.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._dirs = None
+        self._changed = {}
+
+    def listdir(self, dir_):
+        '''
+        Return the file names in the given directory, from the cache if the
+        directory has not been modified since it was cached
+        '''
+        if self._dirs is None:
+            self._dirs = pop.cache.load(self.path)
+        mtime = os.stat(dir_).st_mtime_ns
+        cached = self._dirs.get(dir_)
+        if cached and len(cached) == 3 and cached[0] == mtime and cached[2] - mtime > MTIME_TICK_NS:
+            return cached[1]
+        listed = time.time_ns()
+        fns = os.listdir(dir_)
+        self._dirs[dir_] = self._changed[dir_] = [mtime, fns, listed]
+        _DIRTY.add(self)
+        return fns
+
+    def dump(self):
+        '''
+        Write the changed listings out, merged into the cache file as it is
+        on disk so the listings written by other caches of the file are kept
+        '''
+        if not self._changed:
+            return
+        data = pop.cache.load(self.path)
+        data.update(self._changed)
+        if pop.cache.dump(self.path, data):
+            self._dirs = data
+            self._changed = {}
+            _DIRTY.discard(self)
+
+
+@atexit.register
+def _dump_dirty():
+    '''
+    Write out the caches that still have unwritten listings at exit
+    '''
+    for cache in list(_DIRTY):
+        cache.dump()
+
+
+def mk_cache(cache_dir):
+    '''
+    Return a ScanCache stored in the given cache_dir, or None if caching is
+    not available
+    '''
+    path = pop.cache.path(cache_dir, 'scan')
+    if path:
+        return ScanCache(path)
+    return None
 
 
-def scan(dirs):
+def scan(dirs, cache=None):
     '''
     Return a list of importable files
+
+    :param cache: An optional ScanCache used to skip listing directories
+        that have not changed
     '''
     ret = collections.OrderedDict()
     ret['python'] = collections.OrderedDict()
@@ -23,11 +108,79 @@ def scan(dirs):
     ret['ext'] = collections.OrderedDict()
     ret['imp'] = collections.OrderedDict()
     for dir_ in dirs:
-        for fn_ in os.listdir(dir_):
+        fns = cache.listdir(dir_) if cache else os.listdir(dir_)
+        for fn_ in fns:
             _apply_scan(ret, dir_, fn_)
     return ret
 
 
+def index(scan_data):
+    '''
+    Return a mapping of module basenames to the ifaces and bnames in the scan
+    data that provide them, in scan order
+    '''
+    ret = {}
+    for iface in scan_data:
+        for bname in scan_data[iface]:
+            base = os.path.basename(bname)
+            ret.setdefault(base, collections.OrderedDict()).setdefault(iface, []).append(bname)
+    return ret
+
+
+def vname_index(scan_data):
+    '''
+    Return a mapping of the name each module in the scan data will be loaded
+    under to a list of (position, iface, bname) tuples. The name is read
+    statically from the module's __virtualname__, modules where this is not
+    possible are stored under None.
+    '''
+    ret = {}
+    pos = 0
+    for iface in scan_data:
+        for bname in scan_data[iface]:
+            vname = _static_vname(iface, bname, scan_data[iface][bname]['path'])
+            ret.setdefault(vname, []).append((pos, iface, bname))
+            pos += 1
+    return ret
+
+
+def _static_vname(iface, bname, path):
+    '''
+    Read the __virtualname__ of a python source file without importing it,
+    return None if it cannot be determined
+    '''
+    if iface != 'python' or not path.endswith('.py'):
+        return None
+    try:
+        with open(path, 'rb') as rfh:
+            source = rfh.read()
+    except OSError:
+        return None
+    if b'__virtualname__' not in source:
+        return os.path.basename(bname).split('.')[0]
+    try:
+        tree = ast.parse(source, path)
+    except (SyntaxError, ValueError):
+        return None
+    stores = 0
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == '__virtualname__' and \
+                isinstance(node.ctx, ast.Store):
+            stores += 1
+    if stores != 1:
+        return None
+    for node in tree.body:
+        if not isinstance(node, ast.Assign) or len(node.targets) != 1:
+            continue
+        target = node.targets[0]
+        if not isinstance(target, ast.Name) or target.id != '__virtualname__':
+            continue
+        vname = getattr(node.value, 'value', getattr(node.value, 's', None))
+        if isinstance(vname, str):
+            return vname
+    return None
+
+
 def _apply_scan(ret, dir_, fn_):
     '''
     Convert the scan data into
@@ -1,2 +1,10 @@
 def pre_cping(hub, ctx):
     hub.CPING = True
+
+
+def pre_aping(hub, ctx):
+    assert ctx.args[1] is not None
+
+
+def pre_double(hub, ctx):
+    ctx.args[1] = ctx.args[1] * 2
@@ -0,0 +1,9 @@
+__readonly__ = True
+
+
+def pre_rping(hub, ctx):
+    assert ctx.args[1] is not None
+
+
+def call_rargs(hub, ctx):
+    return type(ctx.args)
@@ -0,0 +1 @@
+__executor__ = 'thread'
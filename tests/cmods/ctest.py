@@ -2,3 +2,9 @@ def cping(hub):
     return True
 
 
+def aping(hub, value):
+    return value
+
+
+def double(hub, value):
+    return value
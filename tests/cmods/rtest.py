@@ -0,0 +1,6 @@
+def rping(hub, value):
+    return value
+
+
+def rargs(hub, value):
+    return value
@@ -0,0 +1,17 @@
+# Import python libs
+import os
+import time
+import threading
+
+# Import pop libs
+import pop.contract
+
+
+def blocking(hub, secs):
+    time.sleep(secs)
+    return threading.current_thread().name
+
+
+@pop.contract.executor('process')
+def in_proc(hub, value):
+    return value, os.getpid()
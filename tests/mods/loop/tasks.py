@@ -0,0 +1,47 @@
+# Import python libs
+import asyncio
+
+
+def __init__(hub):
+    hub.loop.tasks.RUNNING = 0
+    hub.loop.tasks.PEAK = 0
+    hub.loop.tasks.DONE = []
+
+
+async def work(hub, value, secs=0.05):
+    hub.loop.tasks.RUNNING += 1
+    hub.loop.tasks.PEAK = max(hub.loop.tasks.PEAK, hub.loop.tasks.RUNNING)
+    try:
+        await asyncio.sleep(secs)
+    finally:
+        hub.loop.tasks.RUNNING -= 1
+    hub.loop.tasks.DONE.append(value)
+    return value
+
+
+async def fail(hub):
+    raise ValueError('Failed')
+
+
+async def count(hub, start, num, secs=0):
+    try:
+        for value in range(start, start + num):
+            await asyncio.sleep(secs)
+            yield value
+    finally:
+        hub.loop.tasks.DONE.append(('closed', start))
+
+
+async def broken(hub):
+    yield 1
+    await asyncio.sleep(0.01)
+    raise ValueError('Broken')
+
+
+async def nested(hub, secs):
+    await hub.loop.tasks.work('nested', secs)
+    try:
+        await hub.loop.tasks.fail()
+    except ValueError:
+        pass
+    return [value async for value in hub.loop.tasks.count(0, 3)]
@@ -1,4 +1,6 @@
 # Import python libs
+import os
+import asyncio
 import random
 
 
@@ -18,6 +20,11 @@ async def gen(hub, start, end):
         yield x
 
 
+async def broken_gen(hub):
+    yield 1
+    raise ValueError('Broken')
+
+
 def simple_gen(hub, start, end):
     for x in range(start, end):
         yield x
@@ -49,3 +56,48 @@ def gen_last(hub, num=5):
         last = hub.LASTS['last']
         hub.LASTS['last'] = next_
         yield last, next_
+
+
+async def sleep(hub, secs):
+    await asyncio.sleep(secs)
+    return True
+
+
+def echo(hub, value):
+    return value
+
+
+def die(hub):
+    os._exit(1)
+
+
+def type_name(hub, value):
+    return type(value).__name__
+
+
+async def forever(hub):
+    hub.FOREVER = {'closed': False, 'produced': 0}
+    try:
+        while True:
+            yield hub.FOREVER['produced']
+            hub.FOREVER['produced'] += 1
+    finally:
+        hub.FOREVER['closed'] = True
+
+
+def forever_state(hub):
+    return hub.FOREVER['closed'], hub.FOREVER['produced']
+
+
+async def warm(hub, value=True):
+    await asyncio.sleep(0)
+    hub.WARM = value
+
+
+def is_warm(hub):
+    return getattr(hub, 'WARM', False)
+
+
+def bump(hub):
+    hub.BUMPS = getattr(hub, 'BUMPS', 0) + 1
+    return hub.BUMPS
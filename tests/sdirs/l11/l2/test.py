@@ -1,2 +1,14 @@
+# Import python libs
+import os
+
+# Import pop libs
+import pop.contract
+
+
 def ping(hub):
     return True
+
+
+@pop.contract.executor('process')
+def in_proc(hub, value):
+    return value, os.getpid()
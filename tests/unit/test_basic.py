@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
 # pylint: disable=expression-not-assigned
 
+# Import python libs
+import os
+import time
+
 # Import third party libs
 import pytest
 
 # Import pack
 import pop.hub
 import pop.exc
+import pop.cache
+import pop.dirs
+import pop.scanner
 
 
 def test_basic():
@@ -369,3 +376,175 @@ def test_dyne_nest():
     assert hub.dn1.nest.dn3.ping()
     assert hub.dn1.nest.next.test.ping()
     assert hub.dn1.nest.next.last.test.ping()
+
+
+def test_scan_cache(tmpdir):
+    cache_dir = str(tmpdir.mkdir('cache'))
+    mod_dir = tmpdir.mkdir('mods')
+    mod_dir.join('first.py').write('def ping(hub):\n    return 1\n')
+    mod_dir.mkdir('nest').join('second.py').write('def ping(hub):\n    return 2\n')
+    # Listings of directories changed within the last mtime tick are not
+    # trusted, make these look like they were made a while ago
+    for dir_ in (str(mod_dir), str(mod_dir.join('nest'))):
+        os.utime(dir_, (time.time() - 3600,) * 2)
+    hub = pop.hub.Hub(cache_dir=cache_dir)
+    hub.pop.sub.add(static=str(mod_dir), subname='cached')
+    assert hub.cached.first.ping() == 1
+    # The cache is written once the subs are loaded, not on every scan
+    assert not os.path.isfile(os.path.join(cache_dir, 'scan.mp'))
+    hub.pop.sub.load_subdirs(hub.cached)
+    assert hub.cached.nest.second.ping() == 2
+    assert os.path.isfile(os.path.join(cache_dir, 'scan.mp'))
+    assert not hub._scan_cache._changed
+    # A fresh hub reads the listings back from the cache
+    hub = pop.hub.Hub(cache_dir=cache_dir)
+    hub.pop.sub.add(static=str(mod_dir), subname='cached')
+    hub.pop.sub.load_subdirs(hub.cached)
+    assert hub.cached.nest.second.ping() == 2
+    assert not hub._scan_cache._changed
+
+
+def test_scan_cache_shared(tmpdir):
+    cache_dir = str(tmpdir.mkdir('cache'))
+    dirs = []
+    for name in ('one', 'two'):
+        mod_dir = tmpdir.mkdir(name)
+        mod_dir.join('first.py').write('def ping(hub):\n    return 1\n')
+        os.utime(str(mod_dir), (time.time() - 3600,) * 2)
+        dirs.append(str(mod_dir))
+    hub1 = pop.hub.Hub(cache_dir=cache_dir)
+    hub2 = pop.hub.Hub(cache_dir=cache_dir)
+    hub1.pop.sub.add(static=dirs[0], subname='one')
+    hub2.pop.sub.add(static=dirs[1], subname='two')
+    assert hub1._scan_cache in pop.scanner._DIRTY
+    # Both hubs write the same file, neither drops the listings of the other
+    hub1._scan_cache.dump()
+    hub2._scan_cache.dump()
+    data = pop.cache.load(os.path.join(cache_dir, 'scan.mp'))
+    assert set(dirs) <= set(data)
+    # Written caches are no longer held for the exit handler
+    assert hub1._scan_cache not in pop.scanner._DIRTY
+    assert hub2._scan_cache not in pop.scanner._DIRTY
+
+
+def test_scan_cache_invalidate(tmpdir):
+    cache_dir = str(tmpdir.mkdir('cache'))
+    mod_dir = tmpdir.mkdir('mods')
+    mod_dir.join('first.py').write('def ping(hub):\n    return 1\n')
+    hub = pop.hub.Hub(cache_dir=cache_dir)
+    hub.pop.sub.add(static=str(mod_dir), subname='cached')
+    assert hub.cached.first.ping() == 1
+    hub._scan_cache.dump()
+    # Written within the same mtime tick as the cached listing
+    mod_dir.join('second.py').write('def ping(hub):\n    return 2\n')
+    hub = pop.hub.Hub(cache_dir=cache_dir)
+    hub.pop.sub.add(static=str(mod_dir), subname='cached')
+    assert hub.cached.second.ping() == 2
+
+
+def test_dyne_cache(tmpdir):
+    cache_dir = str(tmpdir)
+    hub = pop.hub.Hub(cache_dir=cache_dir)
+    hub.pop.sub.add(dyne_name='dyne1')
+    assert hub.dyne1.test.dyne_ping()
+    index = pop.cache.load(os.path.join(cache_dir, 'dyne.mp'))
+    assert index
+    # The cached index returns the same dirs as a full scan
+    assert pop.dirs.dynamic_dirs(cache_dir) == pop.dirs.dynamic_dirs()
+    hub = pop.hub.Hub(cache_dir=cache_dir)
+    hub.pop.sub.add(dyne_name='dyne1')
+    assert hub.dyne1.nest.nest_dyne_ping()
+    assert hub.dyne2.test.dyne_ping()
+
+
+def test_dyne_cache_conf_changes(tmpdir, monkeypatch):
+    cache_dir = str(tmpdir.mkdir('cache'))
+    site = tmpdir.mkdir('site')
+    first = site.mkdir('first')
+    first.join('conf.py').write('CONFIG = {}\n')
+    second = site.mkdir('second')
+    # Scans taken within an mtime tick of a change are not trusted, make the
+    # packages look like they were installed a while ago
+    for path in (site, first, first.join('conf.py'), second):
+        os.utime(str(path), (time.time() - 3600,) * 2)
+    monkeypatch.syspath_prepend(str(site))
+    assert 'mydyne' not in pop.dirs.dynamic_dirs(cache_dir)
+    index = pop.cache.load(os.path.join(cache_dir, 'dyne.mp'))
+    assert pop.dirs._entry_current(str(site), index[str(site)])
+    # Declaring DYNE in a conf.py that had none is picked up
+    first.join('conf.py').write("CONFIG = {}\nDYNE = {'mydyne': ['dyne']}\n")
+    assert pop.dirs.dynamic_dirs(cache_dir)['mydyne'] == [os.path.join(str(first), 'dyne')]
+    # So is a new conf.py in a package dir that was already scanned
+    second.join('conf.py').write("DYNE = {'otherdyne': ['dyne']}\n")
+    assert pop.dirs.dynamic_dirs(cache_dir)['otherdyne'] == [os.path.join(str(second), 'dyne')]
+
+
+def test_virtualname_lookup_is_lazy():
+    hub = pop.hub.Hub()
+    hub.pop.sub.add('tests.mods')
+    assert hub.mods.truev.present() is True
+    # Only the module declaring the __virtualname__ was loaded
+    assert list(hub.mods._loaded) == ['truev']
+    assert hub.mods.missing is None
+    assert list(hub.mods._loaded) == ['truev']
+
+
+def test_static_vname_index():
+    hub = pop.hub.Hub()
+    hub.pop.sub.add('tests.mods.same_vname', subname='mods')
+    vindex = pop.scanner.vname_index(hub.mods._scan)
+    names = sorted(os.path.basename(bname) for _, _, bname in vindex['vname'])
+    assert names == ['will_load', 'will_not_load']
+    assert None not in vindex
+
+
+def test_mod_hub():
+    hub = pop.hub.Hub()
+    hub.pop.sub.add('tests.mods')
+    mod_hub = hub.mods.test.ping.hub
+    assert isinstance(mod_hub, pop.hub.ModHub)
+    assert mod_hub == hub
+    assert hub == mod_hub
+    assert mod_hub._ is hub.mods.test
+    assert mod_hub.__ is hub.mods
+    assert mod_hub.___ is mod_hub
+    # The state is shared with the hub, but it is not the same object
+    assert mod_hub is not hub
+    assert mod_hub._root is hub
+    assert hub._root is hub
+    mod_hub.new_attr = True
+    assert hub.new_attr is True
+    # Subs keep the root hub, even when they are added from a function on it
+    assert hub.mods._hub is hub
+
+
+def test_ref_cache():
+    hub = pop.hub.Hub()
+    hub.pop.sub.add('tests.mods')
+    ping = getattr(hub, 'mods.test.ping')
+    assert hub._ref_cache['mods.test.ping'][-1] is ping
+    assert hub.pop.ref.last('mods.test.ping') is ping
+    assert getattr(hub.mods, 'test.ping') is ping
+    # Plain attributes on the hub can change at any time, they are not cached
+    hub.pop.ref.create('mods.test.value', 1)
+    assert hub.pop.ref.last('mods.test.value') == 1
+    assert 'mods.test.value' not in hub._ref_cache
+    # The path starts at the root hub, also when it is served from the cache
+    assert hub.pop.ref.path('mods.test.ping')[0] is hub
+    assert hub.pop.ref.path('mods.test.ping')[0] is hub
+    # Replacing a function, like a monkeypatch does, is seen by refs
+    hub.mods.test.ping = lambda: 'patched'
+    assert hub.pop.ref.last('mods.test.ping')() == 'patched'
+    assert getattr(hub, 'mods.test.ping')() == 'patched'
+    hub.mods.test.ping = ping
+    assert getattr(hub, 'mods.test.ping') is ping
+    # So is replacing a module on a sub
+    hub.mods.test = 'patched'
+    assert hub.pop.ref.last('mods.test') == 'patched'
+    del hub.mods.test
+    assert getattr(hub, 'mods.test.ping') is ping
+    # Changing the subs clears the cache
+    hub.pop.ref.last('mods.test.ping')
+    hub.pop.sub.reload('mods')
+    assert hub._ref_cache == {}
+    assert getattr(hub, 'mods.test.ping')() == {}
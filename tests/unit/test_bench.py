@@ -1,5 +1,13 @@
+# Import python libs
+import sys
+import timeit
+import tracemalloc
+
+# Import pop libs
 import pop.hub
+import pop.contract
 repeats = 10000
+startups = 200
 
 
 def test_direct():
@@ -16,6 +24,70 @@ def test_contract():
         hub.cmods.ctest.cping()
 
 
+def _frames(fn):
+    '''
+    Return the names of the python functions called by one call of fn
+    '''
+    fn()
+    calls = []
+    sys.setprofile(lambda frame, event, arg: calls.append(frame.f_code.co_name) if event == 'call' else None)
+    try:
+        fn()
+    finally:
+        sys.setprofile(None)
+    return calls
+
+
+def test_contract_overhead():
+    hub = pop.hub.Hub()
+    hub.pop.sub.add('tests.mods')
+    hub.pop.sub.add('tests.cmods')
+    plain = hub.mods.test.ping
+    contracted = hub.cmods.ctest.cping
+    # The pipeline is composed when the contracts are loaded, a call with one
+    # pre contract only adds the composed call, the context and the contract
+    assert len(_frames(contracted)) == len(_frames(plain)) + 4
+    func = contracted.func
+    pre = contracted.contract_functions['pre'][0]
+
+    def by_hand():
+        ctx = pop.contract.ContractedContext(func, [hub], {}, contracted.signature)
+        pre(ctx)
+        return func(*ctx.args, **ctx.kwargs)
+
+    best = {contracted: float('inf'), by_hand: float('inf')}
+    for _ in range(100):
+        for fn in best:
+            best[fn] = min(best[fn], timeit.timeit(fn, number=2000))
+    # Reading the contract functions on every call took it over 2x
+    assert best[contracted] < best[by_hand] * 2.5
+
+
+def test_contract_args():
+    hub = pop.hub.Hub()
+    hub.pop.sub.add('tests.cmods')
+    for i in range(repeats):
+        hub.cmods.ctest.aping(i)
+
+
+def test_contract_args_readonly():
+    hub = pop.hub.Hub()
+    hub.pop.sub.add('tests.cmods')
+    for i in range(repeats):
+        hub.cmods.rtest.rping(i)
+
+
+def test_contract_get_argument():
+    hub = pop.hub.Hub()
+    hub.pop.sub.add(
+            pypath='tests.mods.contract_ctx',
+            subname='mods',
+            contracts_pypath='tests.contracts'
+            )
+    for i in range(repeats):
+        hub.mods.ctx_args.test('yes', yes=True)
+
+
 def test_via_underscore():
     hub = pop.hub.Hub()
     hub.pop.sub.add('tests.mods')
@@ -28,3 +100,35 @@ def test_via_fqn():
     hub.pop.sub.add('tests.mods')
     for i in range(repeats):
         hub.mods.test.fqn()
+
+
+def test_startup():
+    for i in range(startups):
+        hub = pop.hub.Hub()
+        hub.pop.sub.add('tests.mods')
+        hub.pop.sub.add('tests.cmods')
+
+
+def test_startup_scan_cache(tmpdir):
+    cache_dir = str(tmpdir)
+    for i in range(startups):
+        hub = pop.hub.Hub(cache_dir=cache_dir)
+        hub.pop.sub.add('tests.mods')
+        hub.pop.sub.add('tests.cmods')
+
+
+def test_load_large_sub(tmpdir):
+    mods = tmpdir.mkdir('large')
+    for mod in range(100):
+        funcs = [f'def func_{func}(hub, value):\n    return value\n' for func in range(100)]
+        mods.join(f'mod_{mod}.py').write('\n\n'.join(funcs))
+    tracemalloc.start()
+    hub = pop.hub.Hub()
+    hub.pop.sub.add(static=str(mods), subname='large')
+    hub.pop.sub.load_all('large')
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # Around 1.3KiB per function, copying the function attributes onto the
+    # wrappers took it over 2.5KiB
+    assert size < 10000 * 2048
+    assert hub.large.mod_99.func_99(True)
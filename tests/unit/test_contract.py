@@ -9,3 +9,38 @@ def test_contracted_shortcut():
     c.contract_functions['pre'] = [None]  # add some garbage so we raise if we try to evaluate contracts
 
     c()
+
+
+def test_contracted_hub_bound():
+    def f(hub, value):
+        return hub, value
+
+    c = Contracted(hub="a hub", contracts=[], func=f, ref=None, name=None)
+    assert c('value') == ('a hub', 'value')
+    assert c(value='kw') == ('a hub', 'kw')
+
+
+def test_contracted_recompose():
+    def f(hub, value):
+        return value
+
+    def pre(ctx):
+        ctx.args[1] += 1
+
+    def post(ctx):
+        return ctx.ret * 10
+
+    class Contract:
+        pass
+
+    contract = Contract()
+    contract.pre = pre
+    c = Contracted(hub="a hub", contracts=[contract], func=f, ref=None, name='f')
+    assert c(1) == 2
+    # Changing the contract functions in place composes the call again
+    c.contract_functions['post'].append(post)
+    assert c(1) == 20
+    c.contract_functions['pre'] = []
+    assert c(1) == 10
+    c.contract_functions = {'pre': [], 'call': [], 'post': []}
+    assert c(1) == 1
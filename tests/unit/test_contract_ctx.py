@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
 
+# Import python libs
+import os
+import asyncio
+import inspect
+
 # Import pop
 import pop.hub
+import pop.contract
 import pytest
 
 
@@ -57,3 +63,71 @@ def test_contract_ctx_argument_retrieval():
     with pytest.raises(pop.exc.BindError,
                        match="got an unexpected keyword argument 'garbage'"):
         hub.mods.ctx_args.test('', garbage=True)
+
+
+def test_contract_ctx_readonly():
+    hub = pop.hub.Hub()
+    hub.pop.sub.add('tests.cmods')
+    assert hub.cmods.rtest.rping(1) == 1
+    # Contracts that declare __readonly__ get the args as a tuple
+    assert hub.cmods.rtest.rargs(1) is tuple
+    # Other contracts can still modify the args of the call
+    assert hub.cmods.ctest.aping(2) == 2
+    assert hub.cmods.ctest.double(2) == 4
+
+
+def test_contract_executor():
+    hub = pop.hub.Hub()
+    hub.pop.sub.add('tests.cmods')
+    # Without a running loop the function runs in place
+    assert hub.cmods.xtest.blocking(0) == 'MainThread'
+
+    async def _run():
+        names = await asyncio.gather(*[hub.cmods.xtest.blocking(0.2) for _ in range(4)])
+        stats = hub.pop.loop.executor_stats()
+        value, pid = await hub.cmods.xtest.in_proc(3)
+        return names, stats, value, pid
+
+    hub.pop.loop.executor('thread', max_workers=2)
+    names, stats, value, pid = hub.pop.loop.start(_run())[0]
+    assert all(name.startswith('pop') for name in names)
+    assert stats == {'workers': 2, 'running': 0, 'queued': 0, 'pending': 0, 'submitted': 4, 'done': 4}
+    assert value == 3
+    assert pid != os.getpid()
+    hub.pop.loop.executor('process').shutdown()
+
+
+def test_contract_executor_nested():
+    hub = pop.hub.Hub()
+    hub.pop.sub.add('tests.sdirs')
+    hub.pop.sub.load_subdirs(hub.sdirs, recurse=True)
+
+    async def _run():
+        return await hub.sdirs.l11.l2.test.in_proc(3)
+
+    # The nested subs are added on the hub of the process too
+    value, pid = hub.pop.loop.start(_run())[0]
+    assert value == 3
+    assert pid != os.getpid()
+    hub.pop.loop.executor('process').shutdown()
+
+
+def test_arg_binder():
+    def func(hub, value, yes=True, *, no=False):
+        pass
+
+    signature = inspect.signature(func)
+    binder = pop.contract.ArgBinder.from_signature(signature)
+    assert binder.bind(['hub', 1], {}) == {'hub': 'hub', 'value': 1, 'yes': True, 'no': False}
+    assert binder.bind(('hub',), {'value': 2, 'no': True}) == \
+        {'hub': 'hub', 'value': 2, 'yes': True, 'no': True}
+    # Anything that does not bind cleanly is left to inspect
+    assert binder.bind(('hub',), {}) is None
+    assert binder.bind(('hub', 1), {'value': 2}) is None
+    assert binder.bind(('hub', 1), {'garbage': 2}) is None
+    assert binder.bind(('hub', 1, 2, 3), {}) is None
+
+    def var_func(hub, *args, **kwargs):
+        pass
+
+    assert pop.contract.ArgBinder.from_signature(inspect.signature(var_func)) is None
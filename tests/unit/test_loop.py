@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+# Import python libs
+import sys
+import asyncio
+import importlib
+
+# Import third party libs
+import pytest
+
+# Import pop
+import pop.exc
+import pop.hub
+
+try:
+    importlib.import_module('uvloop')
+    HAS_UVLOOP = True
+except ImportError:
+    HAS_UVLOOP = False
+
+
+def _hub():
+    hub = pop.hub.Hub()
+    hub.pop.sub.add('tests.mods.loop', 'loop')
+    return hub
+
+
+def test_group_limit():
+    hub = _hub()
+    hub.pop.loop.group('limited', limit=2, queue=3)
+
+    async def _run():
+        tasks = [await hub.pop.loop.submit('limited', 'loop.tasks.work', ind) for ind in range(5)]
+        stats = hub.pop.loop.group_stats('limited')
+        # The group is full, submitting blocks until a task is done
+        tasks.append(await hub.pop.loop.submit('limited', 'loop.tasks.work', 5))
+        blocked_done = len(hub.loop.tasks.DONE)
+        await hub.pop.loop.join('limited')
+        return tasks, stats, blocked_done
+
+    tasks, stats, blocked_done = hub.pop.loop.start(_run())[0]
+    assert [task.result() for task in tasks] == list(range(6))
+    assert stats['running'] == 0 and stats['waiting'] == 5
+    assert blocked_done >= 1
+    assert hub.loop.tasks.PEAK == 2
+    assert sorted(hub.loop.tasks.DONE) == list(range(6))
+    stats = hub.pop.loop.group_stats('limited')
+    assert stats['submitted'] == stats['done'] == 6
+    assert not hub.pop.loop.GROUPS['limited']['tasks']
+
+
+def test_group_drop():
+    hub = _hub()
+    hub.pop.loop.group('dropping', limit=1, queue=1, policy='drop')
+
+    async def _run():
+        return [await hub.pop.loop.submit('dropping', 'loop.tasks.work', ind) for ind in range(4)]
+
+    tasks = hub.pop.loop.start(_run())[0]
+    assert tasks[2:] == [None, None]
+    assert hub.pop.loop.group_stats('dropping')['dropped'] == 2
+
+
+def test_ensure_future_reaped():
+    hub = _hub()
+    errors = []
+
+    async def _run():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, ctx: errors.append(ctx['exception']))
+        futures = [hub.pop.loop.ensure_future('loop.tasks.work', ind, 0) for ind in range(3)]
+        futures.append(hub.pop.loop.ensure_future('loop.tasks.fail'))
+        await hub.pop.loop.join()
+        return futures
+
+    futures = hub.pop.loop.start(_run())[0]
+    assert all(fut.done() for fut in futures)
+    assert not hub.pop.loop.GROUPS['default']['tasks']
+    assert hub.pop.loop.group_stats()['failed'] == 1
+    assert isinstance(errors[0], ValueError)
+
+
+def test_fut_que_deprecated():
+    hub = _hub()
+
+    async def _run():
+        # The finished futures are not kept unless the queue is asked for
+        await asyncio.wait([hub.pop.loop.ensure_future('loop.tasks.work', ind, 0) for ind in range(100)])
+        await asyncio.sleep(0)
+        unfed = hub.pop.loop.FUT_QUE.qsize()
+        hub.pop.loop.FEED_FUT_QUE = True
+        futures = [hub.pop.loop.ensure_future('loop.tasks.work', ind, 0) for ind in range(2)]
+        await asyncio.wait(futures)
+        await asyncio.sleep(0)
+        done = [hub.pop.loop.FUT_QUE.get_nowait() for _ in futures]
+        hub.pop.loop.ensure_future('loop.tasks.work', 2, 0)
+        await hub.pop.loop.join()
+        await hub.pop.loop.await_futures()
+        return unfed, futures, done
+
+    unfed, futures, done = hub.pop.loop.start(_run())[0]
+    assert unfed == 0
+    assert set(done) == set(futures)
+    assert hub.pop.loop.FUT_QUE.empty()
+
+
+def test_await_futures_running():
+    hub = _hub()
+
+    async def _run():
+        task = hub.pop.loop.ensure_future('loop.tasks.work', 'server', 60)
+        # Only the finished futures are cleaned up, running tasks are left
+        await asyncio.wait_for(hub.pop.loop.await_futures(), 1)
+        running = not task.done()
+        task.cancel()
+        return running
+
+    assert hub.pop.loop.start(_run())[0]
+
+
+def test_as_yielded():
+    hub = _hub()
+
+    async def _run():
+        ret = {}
+        gens = [hub.loop.tasks.count(ind * 10, 5, 0.001 * ind) for ind in range(3)]
+        ret['all'] = [value async for value in hub.pop.loop.as_yielded(gens, maxsize=2)]
+        gens = [hub.loop.tasks.count(ind * 10, 5, 0.003 - 0.001 * ind) for ind in range(3)]
+        ret['ordered'] = [value async for value in hub.pop.loop.as_yielded(gens, ordered=True)]
+        gens = [hub.loop.tasks.count(ind * 10, 5) for ind in range(3)]
+        ret['batched'] = [batch async for batch in hub.pop.loop.as_batched(gens, max_items=4)]
+        # Stopping early cancels the generators that are still running
+        hub.loop.tasks.DONE.clear()
+        gens = [hub.loop.tasks.count(ind * 10, 1000, 0.001) for ind in range(3)]
+        merged = hub.pop.loop.as_yielded(gens)
+        async for value in merged:
+            break
+        await merged.aclose()
+        ret['closed'] = sorted(hub.loop.tasks.DONE)
+        gens = [hub.loop.tasks.count(0, 1000, 0.001), hub.loop.tasks.broken()]
+        try:
+            async for value in hub.pop.loop.as_yielded(gens):
+                pass
+        except ValueError as exc:
+            ret['exc'] = str(exc)
+        return ret
+
+    ret = hub.pop.loop.start(_run())[0]
+    assert sorted(ret['all']) == [0, 1, 2, 3, 4, 10, 11, 12, 13, 14, 20, 21, 22, 23, 24]
+    assert ret['ordered'] == [0, 1, 2, 3, 4, 10, 11, 12, 13, 14, 20, 21, 22, 23, 24]
+    assert sorted(sum(ret['batched'], [])) == sorted(ret['all'])
+    assert all(0 < len(batch) <= 4 for batch in ret['batched'])
+    assert ret['closed'] == [('closed', 0), ('closed', 10), ('closed', 20)]
+    assert ret['exc'] == 'Broken'
+
+
+def test_as_yielded_maxsize():
+    hub = _hub()
+    produced = [0, 0, 0]
+
+    async def gen(ind):
+        for value in range(10):
+            produced[ind] += 1
+            yield value
+
+    async def _run(ordered):
+        produced[:] = [0, 0, 0]
+        merged = hub.pop.loop.as_yielded([gen(ind) for ind in range(3)], maxsize=2, ordered=ordered)
+        await merged.__anext__()
+        for _ in range(5):
+            await asyncio.sleep(0)
+        await merged.aclose()
+        return list(produced)
+
+    # The generators share the buffer, each one holds back a single value
+    # waiting for room
+    assert sum(hub.pop.loop.start(_run(False))[0]) <= 1 + 2 + 3
+    # Ordered, each generator has a buffer of its own
+    assert hub.pop.loop.start(_run(True))[0][1:] == [3, 3]
+
+
+def test_loop_policy():
+    hub = _hub()
+    assert hub.pop.loop.policy('uvloop') == ('uvloop' if HAS_UVLOOP else 'asyncio')
+    assert hub.pop.loop.policy('asyncio') == 'asyncio'
+    assert type(asyncio.get_event_loop_policy()) is asyncio.DefaultEventLoopPolicy
+    with pytest.raises(pop.exc.PopLookupError):
+        hub.pop.loop.policy('trio')
+
+
+def test_loop_policy_default():
+    hub = _hub()
+    current = asyncio.get_event_loop_policy()
+    hub.pop.loop.create()
+    # Without a configured policy the installed one is left alone
+    assert asyncio.get_event_loop_policy() is current
+    assert hub.pop.loop.POLICY is None
+
+
+def test_loop_debug():
+    hub = _hub()
+    hub.pop.loop.configure(policy='asyncio', debug=True, slow_callback=0.02)
+
+    async def _run():
+        return asyncio.get_running_loop()
+
+    loop = hub.pop.loop.start(_run())[0]
+    assert loop is hub.pop.Loop
+    assert hub.pop.loop.POLICY == 'asyncio'
+    assert loop.get_debug()
+    assert loop.slow_callback_duration == 0.02
+    hub.pop.loop.configure(debug=False)
+    assert not loop.get_debug()
+
+
+def test_loop_conf():
+    hub = _hub()
+    hub.pop.sub.add('pop.mods.conf')
+    hub.conf.loop.setup({'loop_policy': 'asyncio', 'loop_debug': True, 'loop_slow_callback': 0.5})
+    assert hub.pop.loop.CONF == {'policy': 'asyncio', 'debug': True, 'slow_callback': 0.5}
+
+
+def test_loop_integrate(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['blah'])
+    hub = _hub()
+    hub.pop.sub.add('pop.mods.conf')
+    hub.conf.integrate.load('tests.conf1', logs=False, version=False, loop=True)
+    opts = hub.OPT['tests.conf1']
+    assert (opts['loop_policy'], opts['loop_debug'], opts['loop_slow_callback']) == (None, False, 0.1)
+    assert hub.pop.loop.CONF['policy'] is None
@@ -2,8 +2,14 @@
 Test the proc subsystem
 '''
 # Import python libs
+import os
+import asyncio
 import tempfile
+# Import third party libs
+import pytest
+import msgpack
 # Import pop libs
+import pop.exc
 import pop.hub
 
 
@@ -32,8 +38,90 @@ async def _test_create(hub):
     async for ind in hub.proc.run.gen(name, 'mods.proc.simple_gen', 23, 77):
         s.append(ind)
     assert s == e
+    # Failing requests are answered with the error instead of hanging
+    async def _items(ref):
+        return [item async for item in hub.proc.run.gen(name, ref)]
+    ret = await asyncio.wait_for(_items('mods.proc.nope'), 5)
+    assert len(ret) == 1 and ret[0]['status'] is False
+    ret = await asyncio.wait_for(_items('mods.proc.broken_gen'), 5)
+    assert ret == [1, {'status': False, 'exc': 'Broken'}]
+    ret = await asyncio.wait_for(hub.proc.run.set_attr(name, 'nope.nope.value', 1), 5)
+    assert [val['status'] for val in ret.values()] == [False] * 3
+    # A return that can not be encoded
+    ret = await asyncio.wait_for(hub.proc.run.func(name, 'pop.ref.last', 'mods'), 5)
+    assert ret['status'] is False
+    assert ret['exc'].startswith('Failed to send the return')
+    assert await hub.proc.run.func(name, 'mods.test.ping') == {}
     # Test pub
     assert await hub.proc.run.pub(name, 'mods.proc.init_lasts')
+    ret = await hub.proc.run.pub(name, 'mods.proc.sleep', 0.01, _concurrency=2)
+    assert ret == {0: True, 1: True, 2: True}
+    # A failing worker is reported in the return, not raised
+    ret = await hub.proc.run.pub(name, 'mods.proc.sleep', 5, _timeout=0.1)
+    assert sorted(ret) == [0, 1, 2]
+    for val in ret.values():
+        assert val['status'] is False
+
+    # Payloads are framed by length, any bytes can be sent
+    data = b'd\xff\xcfCO)\xfe=' * 3 + b'\x00' * 2 ** 20
+    assert await hub.proc.run.func(name, 'mods.proc.echo', data) == data
+
+    # Many calls can be in flight on the same connection
+    conn = hub.proc.Workers[name][0]['conn']
+    rets = await asyncio.gather(
+        *[hub.proc.run.ind_func(name, 0, 'mods.proc.sleep', 0.05) for _ in range(20)])
+    assert rets == [True] * 20
+    assert hub.proc.Workers[name][0]['conn'] is conn
+
+    # Test batched calls
+    items = list(range(100))
+    assert await hub.proc.run.map(name, 'mods.proc.echo', items, chunksize=7) == items
+    rets = []
+    async for ret in hub.proc.run.imap(name, 'mods.proc.echo', iter(items), 10, ordered=False, window=2):
+        rets.append(ret)
+    assert sorted(rets) == items
+
+    async def agen():
+        for item in items:
+            yield item
+    assert await hub.proc.run.map(name, 'mods.proc.echo', agen(), chunksize=33) == items
+    ret = await hub.proc.run.map(name, 'mods.proc.sleep', ['bad', 0])
+    assert ret[0]['status'] is False
+    assert ret[1] is True
+
+    # A generator only runs ahead of the consumer by its credit and is
+    # cancelled on the worker when the consumer stops
+    ind, agen = await hub.proc.run.track_gen(name, 'mods.proc.forever')
+    async for num in agen:
+        if num == 0:
+            await asyncio.sleep(0.2)
+            closed, produced = await hub.proc.run.ind_func(name, ind, 'mods.proc.forever_state')
+            assert closed is False
+            assert produced <= hub.proc.GEN_CREDIT
+        if num == 100:
+            break
+    await agen.aclose()
+    await asyncio.sleep(0.05)
+    closed, produced = await hub.proc.run.ind_func(name, ind, 'mods.proc.forever_state')
+    assert closed is True
+    assert produced <= 100 + hub.proc.GEN_CREDIT
+
+    # Calls are bounded by a deadline
+    with pytest.raises(asyncio.TimeoutError):
+        await hub.proc.run.ind_func(name, 0, 'mods.proc.sleep', 5, _timeout=0.1)
+    with pytest.raises(asyncio.TimeoutError):
+        async for _ in hub.proc.run.gen(name, 'mods.proc.forever', _timeout=0.1):
+            await asyncio.sleep(0.01)
+    hub.proc.WorkersTrack[name]['timeout'] = 0.1
+    with pytest.raises(asyncio.TimeoutError):
+        await hub.proc.run.func(name, 'mods.proc.sleep', 5)
+    hub.proc.WorkersTrack[name]['timeout'] = None
+    # A request that expired before it started is dropped by the worker
+    bumps = await hub.proc.run.ind_func(name, 0, 'mods.proc.bump')
+    with pytest.raises(asyncio.TimeoutError):
+        await hub.proc.run.ind_func(name, 0, 'mods.proc.bump', _timeout=0)
+    assert await hub.proc.run.ind_func(name, 0, 'mods.proc.bump') == bumps + 1
+    assert hub.proc.Workers[name][0]['inflight'] == 0
 
     # Test track and ind func calls
     ind, coro = await hub.proc.run.track_func(name, 'mods.proc.echo_last')
@@ -49,13 +137,41 @@ async def _test_create(hub):
             assert next_1 == last_2
             next_1 = next_2
 
+    # Test dispatch policies
+    track = hub.proc.WorkersTrack[name]
+    track['policy'] = 'affinity'
+    inds = set()
+    for _ in range(10):
+        ind, coro = await hub.proc.run.track_func(name, 'mods.proc.echo', 1, _key='user-1')
+        assert await coro == 1
+        inds.add(ind)
+    assert len(inds) == 1
+    track['policy'] = 'least_loaded'
+    ind, coro = await hub.proc.run.track_func(name, 'mods.proc.sleep', 0.2)
+    slow = asyncio.ensure_future(coro)
+    await asyncio.sleep(0.05)
+    assert hub.proc.Workers[name][ind]['inflight'] == 1
+    for _ in range(5):
+        assert hub.proc.run.pick(name) != ind
+    assert await slow is True
+    assert hub.proc.Workers[name][ind]['inflight'] == 0
+    track['policy'] = 'p2c'
+    assert await hub.proc.run.func(name, 'mods.test.ping') == {}
+    track['policy'] = 'round_robin'
+
     # Test add_proc
     pre = len(hub.proc.Workers[name])
-    await hub.proc.run.add_proc(name)
+    ind = await hub.proc.run.add_proc(name)
     post = len(hub.proc.Workers[name])
     assert pre < post
-    for _ in range(20):
-        ret = await hub.proc.run.func(name, 'mods.test.ping')
+    inds = set()
+    for _ in range(post * 2):
+        w_ind, coro = await hub.proc.run.track_func(name, 'mods.test.ping')
+        assert await coro == {}
+        inds.add(w_ind)
+    # Round robin reaches the new worker
+    assert ind in inds
+    assert inds == set(hub.proc.Workers[name])
 
 
 def test_create():
@@ -64,3 +180,135 @@ def test_create():
     hub.pop.sub.add('pop.mods.proc')
     hub.pop.sub.add('tests.mods')
     hub.pop.loop.start(_test_create(hub))
+
+
+async def _test_fork(hub):
+    name = 'Forked'
+    await hub.proc.init.pool(
+        2, name, sock_dir=tempfile.mkdtemp(), fork=True, subs=['tests.mods'], warmup=['mods.proc.warm'])
+    assert await hub.proc.run.pub(name, 'mods.proc.is_warm') == {0: True, 1: True}
+    # The subs are loaded on the template hub before the workers are forked
+    for _ in range(4):
+        assert await hub.proc.run.func(name, 'mods.test.ping') == {}
+    pids = {worker['pid'] for worker in hub.proc.Workers[name].values()}
+    assert len(pids) == 2
+    assert os.getpid() not in pids
+    ind = await hub.proc.run.add_proc(name)
+    assert await hub.proc.run.ind_func(name, ind, 'mods.proc.echo', 3) == 3
+    # The warmup arguments reach executed and forked workers the same way
+    value = {'raw': b'\x00\'"', 'text': 'it\'s "quoted"', 'pair': (1, 2)}
+    for fork in (False, True):
+        await hub.proc.init.pool(
+            1, f'Warm{fork}', sock_dir=tempfile.mkdtemp(), fork=fork, subs=['tests.mods'],
+            warmup=[{'ref': 'mods.proc.warm', 'args': [value]}])
+        assert await hub.proc.run.pub(f'Warm{fork}', 'mods.proc.is_warm') == {
+            0: {'raw': b'\x00\'"', 'text': 'it\'s "quoted"', 'pair': [1, 2]}}
+
+
+def test_fork():
+    hub = pop.hub.Hub()
+    hub.opts = {}
+    hub.pop.sub.add('pop.mods.proc')
+    hub.pop.sub.add('tests.mods')
+    hub.pop.loop.start(_test_fork(hub))
+
+
+async def _test_restart(hub, fork):
+    name = f'Restart{fork}'
+    hub.proc.BACKOFF_BASE = 0.01
+    await hub.proc.init.pool(2, name, sock_dir=tempfile.mkdtemp(), fork=fork)
+    await hub.proc.run.add_sub(name, 'tests.mods')
+    workers = hub.proc.Workers[name]
+    pid = workers[0]['pid']
+    # The call in flight on the dead worker fails instead of hanging
+    with pytest.raises(ConnectionResetError):
+        await hub.proc.run.ind_func(name, 0, 'mods.proc.die')
+    # Calls are routed to the live worker while the dead one is respawned
+    for _ in range(4):
+        assert await hub.proc.run.func(name, 'mods.test.ping') == {}
+    while hub.proc.WorkersTrack[name]['restarts'].get(0) != 1:
+        await asyncio.sleep(0.01)
+    await workers[0]['ready']
+    assert workers[0]['pid'] != pid
+    # The subs added to the pool are loaded on the respawned worker
+    assert await hub.proc.run.ind_func(name, 0, 'mods.proc.echo', 5) == 5
+
+
+def test_restart():
+    hub = pop.hub.Hub()
+    hub.opts = {}
+    hub.pop.sub.add('pop.mods.proc')
+    hub.pop.sub.add('tests.mods')
+    hub.pop.loop.start(_test_restart(hub, False), _test_restart(hub, True))
+
+
+async def _test_shm(hub):
+    name = 'Shm'
+    await hub.proc.init.pool(
+        2,
+        name,
+        sock_dir=tempfile.mkdtemp(),
+        shm=1024,
+        subs=['tests.mods'],
+        warmup=[{'ref': 'mods.proc.warm', 'args': ['yes']}])
+    assert await hub.proc.run.pub(name, 'mods.proc.is_warm') == {0: 'yes', 1: 'yes'}
+    # A worker that fails to warm up is never ready
+    with pytest.raises(pop.exc.ProcessNotStarted):
+        await hub.proc.init.pool(
+            1, 'Cold', sock_dir=tempfile.mkdtemp(), subs=['tests.mods'], warmup=['mods.proc.nope'], restart=False)
+    data = os.urandom(4 * 2 ** 20)
+    # Large buffers are received as a view of the shared memory
+    assert await hub.proc.run.func(name, 'mods.proc.type_name', data) == 'memoryview'
+    assert await hub.proc.run.func(name, 'mods.proc.type_name', b'small') == 'bytes'
+    ret = await hub.proc.run.func(name, 'mods.proc.echo', {'blob': data, 'items': [data]})
+    assert ret['blob'] == data
+    assert ret['items'][0] == data
+    # The segments are unlinked once they are received
+    assert not [seg for seg in os.listdir(hub.proc.shm.DIR) if seg.startswith('pop-proc-')]
+    # A request naming a segment that is gone fails on its own
+    gone = msgpack.ExtType(hub.proc.shm.EXT, b'pop-proc-' + b'0' * 16)
+    ret = await hub.proc.run.ind_func(name, 0, 'mods.proc.echo', gone)
+    assert ret['status'] is False
+    assert 'FileNotFoundError' in ret['exc']
+    # Only the names made for segments are opened
+    victim = tempfile.NamedTemporaryFile(dir=tempfile.gettempdir(), delete=False).name
+    rel = os.path.relpath(victim, hub.proc.shm.DIR).encode()
+    ret = await hub.proc.run.ind_func(name, 0, 'mods.proc.echo', msgpack.ExtType(hub.proc.shm.EXT, rel))
+    assert ret['status'] is False
+    assert 'Invalid shared memory segment name' in ret['exc']
+    assert os.path.exists(victim)
+    os.unlink(victim)
+    # A connection that closes only releases the segments sent on it
+    worker = hub.proc.Workers[name][0]
+    reader, writer = await asyncio.open_unix_connection(path=worker['path'])
+    payload = {'fun': 'run', 'ref': 'mods.proc.echo', 'args': [data], 'kwargs': {}}
+    await hub.proc.wire.send(writer, asyncio.Lock(), 1, hub.proc.R_FLAG, payload)
+    await asyncio.sleep(0.2)
+    (await hub.proc.run.conn(worker))['writer'].close()
+    await asyncio.sleep(0.2)
+    assert await hub.proc.wire.recv(reader, True) == (1, hub.proc.D_FLAG, data)
+    writer.close()
+    # Calls that time out release their segments while the others go on
+    rets = await asyncio.gather(
+        *[hub.proc.run.ind_func(name, 0, 'mods.proc.type_name', data, _timeout=0 if ind % 2 else None)
+          for ind in range(20)],
+        return_exceptions=True)
+    assert rets[::2] == ['memoryview'] * 10
+    assert all(isinstance(ret, asyncio.TimeoutError) for ret in rets[1::2])
+    assert await hub.proc.run.ind_func(name, 0, 'mods.proc.type_name', data) == 'memoryview'
+
+
+async def _test_no_shm(hub):
+    name = 'NoShm'
+    await hub.proc.init.pool(1, name, sock_dir=tempfile.mkdtemp(), subs=['tests.mods'])
+    # Without shm the extension types of the payload are left alone
+    ext = msgpack.ExtType(hub.proc.shm.EXT, b'../not-a-segment')
+    assert await hub.proc.run.func(name, 'mods.proc.echo', ext) == ext
+
+
+def test_shm():
+    hub = pop.hub.Hub()
+    hub.opts = {}
+    hub.pop.sub.add('pop.mods.proc')
+    hub.pop.sub.add('tests.mods')
+    hub.pop.loop.start(_test_shm(hub), _test_no_shm(hub))
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+# Import python libs
+import json
+
+# Import pop
+import pop.hub
+import pop.contract
+
+
+def test_profile():
+    hub = pop.hub.Hub()
+    hub.pop.sub.add('tests.mods')
+    hub.pop.sub.add('tests.mods.loop', 'loop')
+    hub.mods.test.ping()
+    assert not hub.pop.profile.running()
+    assert hub.pop.profile.stats() == {}
+
+    hub.pop.profile.start()
+    try:
+        assert hub.pop.profile.running()
+        for _ in range(3):
+            hub.mods.test.ping()
+        assert hub.pop.loop.start(hub.loop.tasks.nested(0.05))[0] == [0, 1, 2]
+    finally:
+        stats = hub.pop.profile.stop()
+    assert pop.contract.PROFILER is None
+    hub.mods.test.ping()
+
+    assert stats['mods.test.ping']['calls'] == 3
+    assert stats['loop.tasks.fail']['exceptions'] == 1
+    assert stats['loop.tasks.count']['calls'] == 1
+    nested = stats['loop.tasks.nested']
+    work = stats['loop.tasks.work']
+    assert nested['cumtime'] >= work['cumtime'] >= 0.05
+    assert nested['selftime'] < 0.05
+    assert not [key for key in stats if key.startswith('pop.profile')]
+
+    assert json.loads(hub.pop.profile.dump('json')) == json.loads(json.dumps(stats))
+    table = hub.pop.profile.dump('table', sort='calls', limit=1)
+    assert table.splitlines()[1].endswith('mods.test.ping')
+    stacks = dict(line.rsplit(' ', 1) for line in hub.pop.profile.dump('collapsed').splitlines())
+    assert 'loop.tasks.nested;loop.tasks.work' in stacks
+    assert 'loop.tasks.nested;loop.tasks.count' in stacks